@@ -0,0 +1,421 @@
+# API client for osprey_worker.py
+import os
+import json
+import base64
+import time
+import queue
+import random
+import hashlib
+import sqlite3
+import threading
+from typing import NamedTuple
+# Optional, to parse large responses without loading them whole
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Get settings
+import settings
+# Timing of the requests
+from metrics import timed
+# Long values are cut in the log
+from worker_logging import Truncated
+
+# Errors of the JSON parsers
+JSON_ERRORS = (ValueError,) if ijson is None else (ValueError, ijson.JSONError)
+
+
+# One session per process, so connections to the API are reused
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Get the requests session of this process, with a pool of connections
+    sized for the threads that use it
+    """
+    global _session, _session_pid
+    # Imported on first use, the worker processes do not send requests
+    import requests
+    from requests.adapters import HTTPAdapter
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            pool_size = getattr(settings, 'http_workers', 4) + getattr(settings, 'api_workers', 4)
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session_pid = os.getpid()
+    return _session
+
+
+# Responses that may work if the request is sent again
+RETRY_STATUS = {408, 425, 429, 500, 502, 503, 504}
+# Of those, the ones where the API did not process the request
+NOT_PROCESSED_STATUS = {425, 429}
+
+
+def is_idempotent(url):
+    """
+    False for the requests that insert a record (/new), which the API would
+    insert twice if it received the request again
+    """
+    return "/new/" not in url
+
+
+def request_not_sent(e):
+    """
+    True if a request failed before reaching the API: no connection
+    could be made, so it is safe to send it again
+    """
+    import requests
+    import urllib3
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if len(e.args) > 0 else None
+    return isinstance(e, requests.ConnectionError) and isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def backoff_delay(attempt):
+    """
+    Seconds to wait before trying a request again: exponential backoff with full jitter
+    """
+    base = getattr(settings, 'api_backoff', 1)
+    cap = getattr(settings, 'api_backoff_max', 60)
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def request_key(url, payload):
+    """
+    Idempotency key of a request, the same for the same url and values
+    """
+    values = {k: v for k, v in payload.items() if k != 'api_key'}
+    key = json.dumps([url, values], sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def post_request(url, payload, logger, log_res = True, retries = None, parse = None):
+    """
+    Execute request to API, trying again with backoff on connection errors
+    and temporary errors of the API. Requests that insert a record are only
+    sent again if they did not reach the API. parse is a function that reads the
+    results from the response body as it arrives, json.loads of the
+    whole body if None.
+    Returns (results, transient), results is False if the request failed and
+    transient is True if it may work later.
+    """
+    import requests
+    import urllib3
+    if retries is None:
+        retries = getattr(settings, 'api_retries', 3)
+    timeout = getattr(settings, 'api_timeout', 120)
+    headers = {'Idempotency-Key': request_key(url, payload)}
+    idempotent = is_idempotent(url)
+    logger.info("send_request: %s|%s", url, Truncated(payload))
+    for attempt in range(retries + 1):
+        try:
+            with timed('api'):
+                r = get_session().post(url, data=payload, headers=headers, timeout=timeout, stream=parse is not None)
+                if r.status_code == 200 and parse is not None:
+                    r.raw.decode_content = True
+                    try:
+                        results = parse(r.raw)
+                    finally:
+                        r.close()
+        except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+            # Includes the errors reading a response as it arrives
+            if not idempotent and not request_not_sent(e):
+                logger.error("send_request: %s|%s|Not sent again, the API may have received it (%s)",
+                             url, Truncated(payload), e)
+                return False, False
+            logger.warning("send_request: %s|attempt %s|%s", url, attempt + 1, e)
+        except JSON_ERRORS as e:
+            logger.error("send_request: %s|%s|Invalid response (%s)", url, Truncated(payload), e)
+            return False, False
+        else:
+            if r.status_code == 200:
+                if parse is None:
+                    try:
+                        results = json.loads(r.content)
+                    except ValueError as e:
+                        logger.error("send_request: %s|%s|Invalid response (%s)", url, Truncated(payload), e)
+                        return False, False
+                if log_res:
+                    logger.info("send_request_res: %s", Truncated(results))
+                return results, False
+            r.close()
+            if r.status_code not in RETRY_STATUS or (not idempotent and r.status_code not in NOT_PROCESSED_STATUS):
+                logger.error("send_request: %s|%s|%s|%s", url, Truncated(payload), r.status_code, r.headers)
+                return False, False
+            logger.warning("send_request: %s|attempt %s|%s", url, attempt + 1, r.status_code)
+        if attempt < retries:
+            time.sleep(backoff_delay(attempt))
+    logger.error("send_request: %s|%s|Failed after %s attempts", url, Truncated(payload), retries + 1)
+    return False, True
+
+
+def send_request(url, payload, logger, log_res = True):
+    """
+    Execute request to API
+    """
+    results, transient = post_request(url, payload, logger, log_res)
+    return results
+
+
+class FileInfo(NamedTuple):
+    """
+    A file of a folder in the API, with only the values the checks use
+    """
+    file_id: int
+    file_name: str
+
+
+def parse_records(fp, array_key, record):
+    """
+    Parse a JSON object from the file-like fp as it is read, turning each item
+    of the array in array_key into a record (a NamedTuple with fields from the
+    keys of the item). Other keys are returned as they are.
+    Uses ijson if installed, otherwise loads the whole body at once.
+    """
+    if ijson is None:
+        results = json.load(fp)
+        results[array_key] = [record(*(item.get(field) for field in record._fields))
+                              for item in results.get(array_key, [])]
+        return results
+    item_prefix = f"{array_key}.item"
+    builder = ijson.ObjectBuilder()
+    item_builder = None
+    records = []
+    for prefix, event, value in ijson.parse(fp):
+        if item_builder is not None:
+            item_builder.event(event, value)
+            if prefix == item_prefix and event == 'end_map':
+                item = item_builder.value
+                records.append(record(*(item.get(field) for field in record._fields)))
+                item_builder = None
+        elif prefix == item_prefix and event == 'start_map':
+            item_builder = ijson.ObjectBuilder()
+            item_builder.event(event, value)
+        else:
+            builder.event(event, value)
+    results = builder.value
+    results[array_key] = records
+    return results
+
+
+def get_records(url, payload, logger, array_key, record):
+    """
+    Get a JSON object from the API, with the items of array_key as records (see
+    parse_records). If settings.api_page_size is set, the items are requested
+    in pages of that size with 'page' and 'page_size' in the payload, until a
+    page is not full; the other values are from the first page. If the API
+    does not page the items (a page longer than page_size, or the same first
+    item as the first page) they are requested again without pages.
+    Returns False if a request failed.
+    """
+    page_size = getattr(settings, 'api_page_size', None)
+    parse = lambda fp: parse_records(fp, array_key, record)
+    if page_size is None:
+        results, transient = post_request(url, payload, logger, log_res = False, parse = parse)
+        return results
+    results = None
+    page = 1
+    while True:
+        page_payload = dict(payload, page=page, page_size=page_size)
+        page_results, transient = post_request(url, page_payload, logger, log_res = False, parse = parse)
+        if page_results is False:
+            return False
+        items = page_results[array_key]
+        if len(items) > page_size and page == 1:
+            # page_size ignored, all the items are here
+            return page_results
+        if len(items) > page_size or (page > 1 and len(items) > 0 and items[0] == results[array_key][0]):
+            logger.warning(f"API does not page {url} (page {page}), requesting all the items")
+            results, transient = post_request(url, payload, logger, log_res = False, parse = parse)
+            return results
+        if results is None:
+            results = page_results
+        else:
+            results[array_key].extend(page_results[array_key])
+        if len(items) < page_size:
+            return results
+        page += 1
+
+
+class Outbox(object):
+    """
+    Requests that could not be sent to the API, saved in a SQLite file to
+    send them later instead of running the checks again
+    """
+    def __init__(self, path):
+        # path as set in settings, and the absolute path: each request opens the file
+        # again, so a change of the working directory does not move the outbox
+        self.name = path
+        self.path = os.path.abspath(path)
+        self.lock = threading.Lock()
+        with self.lock, sqlite3.connect(self.path) as con:
+            con.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "request_key TEXT UNIQUE, url TEXT, payload TEXT, created TEXT, folder_id TEXT)")
+            # Outbox files from before folder_id
+            columns = [row[1] for row in con.execute("PRAGMA table_info(outbox)")]
+            if 'folder_id' not in columns:
+                con.execute("ALTER TABLE outbox ADD COLUMN folder_id TEXT")
+
+    def add(self, url, payload, folder_id=None):
+        """
+        Save a request of the folder folder_id, the api_key is not saved. Values in
+        bytes (the EXIF output) are saved in base64 and sent as bytes again.
+        """
+        values = {k: {'base64': base64.b64encode(v).decode('ascii')} if isinstance(v, bytes) else v
+                  for k, v in payload.items() if k != 'api_key'}
+        with self.lock, sqlite3.connect(self.path) as con:
+            con.execute("INSERT OR IGNORE INTO outbox (request_key, url, payload, created, folder_id) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (request_key(url, payload), url, json.dumps(values, default=str),
+                         time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+                         None if folder_id is None else str(folder_id)))
+
+    def __len__(self):
+        with self.lock, sqlite3.connect(self.path) as con:
+            return con.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def replay(self, logger):
+        """
+        Send the saved requests in the order they were saved.
+        Stops at the first one that fails for a temporary reason. Returns True if
+        the outbox is empty, and the set of folder_ids with requests sent, which
+        have to be checked again to be completed. The folder_ids are strings, as
+        saved: numbers, or UUIDs in transcription projects.
+        """
+        with self.lock, sqlite3.connect(self.path) as con:
+            rows = con.execute("SELECT id, url, payload, folder_id FROM outbox ORDER BY id").fetchall()
+        folder_ids = set()
+        if len(rows) == 0:
+            return True, folder_ids
+        logger.info(f"Sending {len(rows)} requests from outbox {self.path}")
+        for row_id, url, payload, folder_id in rows:
+            payload = {k: base64.b64decode(v['base64']) if isinstance(v, dict) and 'base64' in v else v
+                       for k, v in json.loads(payload).items()}
+            payload['api_key'] = settings.api_key
+            results, transient = post_request(url, payload, logger, retries=0)
+            if results is False and transient:
+                logger.warning(f"API not available, {self.path} will be sent later")
+                return False, folder_ids
+            if results is False:
+                logger.error("Outbox request rejected by the API, removed: %s|%s", url, Truncated(payload))
+            if folder_id is not None:
+                folder_ids.add(folder_id)
+            # Removed once it was sent
+            with self.lock, sqlite3.connect(self.path) as con:
+                con.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+        return True, folder_ids
+
+
+_outbox = None
+
+
+def get_outbox():
+    """
+    Get the outbox set in settings, None if not used
+    """
+    global _outbox
+    path = getattr(settings, 'api_outbox', None)
+    if path is None:
+        return None
+    if _outbox is None or _outbox.name != path:
+        _outbox = Outbox(path)
+    return _outbox
+
+
+class ResultSubmitter(object):
+    """
+    Send results to the API in the background, so the workers can keep
+    running checks instead of waiting for each round-trip.
+
+    Each job is a list of (url, payload, log_res) sent in order, jobs are
+    sent by api_workers threads at the same time. If a request can't be
+    sent, it and the rest of its job are saved in the outbox. Call flush()
+    before using the API state that depends on the results.
+
+    on_done, if given to submit(), is called from the sending thread with
+    True when the whole job was sent or saved in the outbox. The names of
+    the jobs saved in the outbox are in saved: the folder_id the results
+    belong to is not complete until they are sent.
+    """
+    def __init__(self, logger, workers=None, folder_id=None):
+        self.logger = logger
+        self.folder_id = folder_id
+        if workers is None:
+            workers = getattr(settings, 'api_workers', 4)
+        self.outbox = get_outbox()
+        # Bounded, so the workers slow down if the API can't keep up
+        self.queue = queue.Queue(maxsize=workers * 16)
+        self.failed = []
+        self.saved = []
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._worker, name=f"submit_{i}", daemon=True)
+                        for i in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    def submit(self, name, job, on_done=None):
+        """
+        Queue a list of requests, name is used to report failures
+        """
+        self.queue.put((name, job, on_done))
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                name, job, on_done = item
+                done = True
+                for i, (url, payload, log_res) in enumerate(job):
+                    results, transient = post_request(url, payload, self.logger, log_res)
+                    if results is False:
+                        if transient and self.outbox is not None:
+                            for url, payload, log_res in job[i:]:
+                                self.outbox.add(url, payload, self.folder_id)
+                            self.logger.warning(f"Results of {name} saved to outbox")
+                            with self.lock:
+                                self.saved.append(name)
+                        else:
+                            done = False
+                            with self.lock:
+                                self.failed.append(name)
+                        break
+                if on_done is not None:
+                    on_done(done)
+            except Exception as e:
+                self.logger.error(f"ResultSubmitter: {e}")
+                with self.lock:
+                    self.failed.append(item[0])
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """
+        Wait until all the queued results were sent, returns the names of the
+        jobs that failed since the last flush
+        """
+        self.queue.join()
+        with self.lock:
+            failed = self.failed
+            self.failed = []
+        return failed
+
+    def close(self):
+        """
+        Send what is left and stop the threads
+        """
+        failed = self.flush()
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        return failed
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#
+# End-to-end benchmark: checks a synthetic folder with run_checks_folder_p
+# against the mock API (mock_api.py) and reports the files per second and
+# the API calls per file. Uses the settings in settings.py for everything
+# but the API, the folders and the previews; the programs in settings
+# (jhove, exiftool, identify) have to be installed.
+#
+# Usage: python benchmarks/bench_e2e.py [--files 50] [--mp 1] [--workers 4]
+#                                       [--checks unique_file,tifpages,tif_compression]
+#                                       [--latency 0.02] [--error-rate 0.01] [--output results.json]
+#
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings
+import functions
+import mock_api
+from worker_logging import setup_logging, stop_logging
+from corpus import image_size, make_image, write_eip
+from bench_functions import git_commit
+
+
+def make_folder(folder_path, no_files, megapixels, raw_pairs):
+    """
+    Folder with no_files copies of a synthetic TIFF, their raw pairs and an md5 file
+    """
+    os.makedirs(folder_path)
+    size = image_size(megapixels)
+    img = make_image('RGB', size)
+    img.save(os.path.join(folder_path, f"file_0000{settings.main_files}"), compression='tiff_lzw')
+    if raw_pairs:
+        write_eip(os.path.join(folder_path, f"file_0000{settings.raw_files}"), size[0] * size[1] // 4)
+    with open(os.path.join(folder_path, f"file_0000{settings.main_files}"), 'rb') as f:
+        tif_data = f.read()
+    for i in range(1, no_files):
+        with open(os.path.join(folder_path, f"file_{i:04}{settings.main_files}"), 'wb') as f:
+            f.write(tif_data)
+        if raw_pairs:
+            write_eip(os.path.join(folder_path, f"file_{i:04}{settings.raw_files}"), size[0] * size[1] // 4)
+    records = functions.scan_folder(folder_path)
+    with open(os.path.join(folder_path, f"checksums{settings.md5_file}"), 'w') as f:
+        for record in records:
+            f.write(f"{functions.file_digest(record.path)}  {record.name}\n")
+
+
+def run(args, tmp_folder):
+    server = mock_api.serve(project_alias="bench", project_checks=args.checks, latency=args.latency,
+                            jitter=args.jitter, error_rate=args.error_rate, drop_rate=args.drop_rate, seed=args.seed)
+    # Everything local to this run
+    settings.api_url = server.url
+    settings.api_key = "bench"
+    settings.project_alias = "bench"
+    settings.project_datastorage = os.path.join(tmp_folder, "data")
+    settings.jpg_previews = os.path.join(tmp_folder, "previews")
+    settings.jpg_previews_free = None
+    settings.previews = True
+    settings.run_once = False
+    settings.checkpoints = None
+    settings.api_outbox = None
+    settings.folder_date = lambda folder_name: time.strftime("%Y-%m-%d")
+    if args.workers is not None:
+        settings.no_workers = args.workers
+    os.makedirs(settings.jpg_previews)
+    folder_path = os.path.join(settings.project_datastorage, "bench_folder")
+    make_folder(folder_path, args.files, args.mp, 'raw_pair' in args.checks.split(','))
+    log_file = os.path.join(tmp_folder, "bench.log")
+    # As the worker, with the records of the worker processes
+    setup_logging(log_file, level=logging.INFO, fmt="%(levelname)s:%(name)s:%(message)s")
+    logger = logging.getLogger("osprey")
+    project_info = server.mock.project()
+    server.mock.reset_stats()
+    start = time.perf_counter()
+    res = functions.run_checks_folder_p(project_info, folder_path, tmp_folder, logger)
+    seconds = time.perf_counter() - start
+    stats = server.mock.stats()
+    server.shutdown()
+    stop_logging()
+    with open(log_file) as f:
+        log_errors = sum(1 for line in f if line.startswith("ERROR"))
+    return {
+        'result': res,
+        'files': args.files,
+        'megapixels': args.mp,
+        'workers': settings.no_workers,
+        'checks': args.checks,
+        'seconds': seconds,
+        'files_s': args.files / seconds,
+        'api_calls': stats['requests'],
+        'api_calls_per_file': stats['requests'] / args.files,
+        'log_errors': log_errors,
+        'api': stats,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end benchmark with the mock API")
+    parser.add_argument('--files', type=int, default=50, help="Files in the folder")
+    parser.add_argument('--mp', type=int, default=1, help="Megapixels of each file")
+    parser.add_argument('--workers', type=int, help="no_workers, from settings.py if not set")
+    parser.add_argument('--checks', default="unique_file,tifpages,tif_compression",
+                        help="project_checks of the project in the mock API")
+    parser.add_argument('--latency', type=float, default=0, help="Seconds added to each API request")
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0, help="Share of API requests that return 503")
+    parser.add_argument('--drop-rate', type=float, default=0, help="Share of API requests closed without a response")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="JSON file for the results, stdout if not set")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(dir=os.environ.get('TMPDIR', '/tmp')) as tmp_folder:
+        results = run(args, tmp_folder)
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+    print(f"{results['files']} files in {results['seconds']:.2f} s: {results['files_s']:.2f} files/s, "
+          f"{results['api_calls_per_file']:.1f} API calls per file, {results['log_errors']} errors in the log",
+          file=sys.stderr)
+    if args.output is None:
+        print(json.dumps(report, indent=1))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
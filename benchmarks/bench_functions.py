@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+#
+# Time the checks in functions.py and si_deepzoom on a synthetic corpus
+# (see corpus.py): seconds, MB/s and peak RSS of each function on each
+# file, saved to JSON to compare the results between commits.
+# Each measurement runs in a new process, so the peak RSS is its own.
+#
+# Usage: python benchmarks/bench_functions.py [--corpus folder] [--sizes 1,12]
+#                                             [--functions tifpages,...] [--repeat 1]
+#                                             [--output results.json]
+#
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings
+import functions
+import si_deepzoom as deepzoom
+from functions import scan_folder, check_requirements
+from corpus import make_corpus
+
+
+logger = logging.getLogger("osprey")
+
+
+def deepzoom_create(file_path, out_folder, file_id):
+    creator = deepzoom.ImageCreator(tile_size=254, tile_format='jpg', image_quality=1.0, resize_filter='antialias')
+    creator.create(file_path, f"{out_folder}/dz_{file_id}.dzi")
+
+
+# Functions to time on each file: (applies to, function(file_path, out_folder, file_id))
+FILE_FUNCTIONS = {
+    'get_filemd5': (('.tif', '.eip'), lambda file_path, out_folder, file_id: functions.get_filemd5(file_path, logger)),
+    'tifpages': (('.tif',), lambda file_path, out_folder, file_id: functions.tifpages(file_path)),
+    'tif_compression': (('.tif',), lambda file_path, out_folder, file_id: functions.tif_compression(file_path)),
+    'jhove_validate': (('.tif', '.eip'), lambda file_path, out_folder, file_id: functions.jhove_validate(file_path)),
+    'magick_validate': (('.tif',), lambda file_path, out_folder, file_id: functions.magick_validate(file_path)),
+    'jpgpreview': (('.tif',), lambda file_path, out_folder, file_id: functions.jpgpreview(file_id, 1, file_path, logger)),
+    'jpgpreview_zoom': (('.tif',), lambda file_path, out_folder, file_id: functions.jpgpreview_zoom(file_id, 1, file_path, logger)),
+    'ImageCreator.create': (('.tif',), deepzoom_create),
+}
+# Programs needed by some functions
+REQUIRED_PROGRAMS = {
+    'jhove_validate': lambda: settings.jhove,
+    'magick_validate': lambda: 'identify' if settings.magick is None else settings.magick,
+}
+
+
+def rss_kb():
+    """
+    Current RSS of this process in KB
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def measure(func, args, repeat, conn):
+    """
+    Run in a new process: best time of repeat runs and the peak RSS
+    of the process and of the programs it ran
+    """
+    result = {'rss_start_kb': rss_kb()}
+    try:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            res = func(*args)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        result['seconds'] = best
+        result['result'] = str(res)[:200]
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['children_peak_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    conn.send(result)
+    conn.close()
+
+
+def run_measure(func, args, repeat):
+    ctx = multiprocessing.get_context('fork')
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    p = ctx.Process(target=measure, args=(func, args, repeat, child_conn))
+    p.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = {'error': f"process exited with code {p.exitcode}"}
+    p.join()
+    return result
+
+
+def validate_md5_corpus(corpus_folder):
+    records = [record for record in scan_folder(corpus_folder) if record.suffix in ('.tif', '.eip')]
+    return functions.validate_md5([os.path.join(corpus_folder, "corpus.md5")], records, logger)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(corpus_folder, names, repeat, out_folder):
+    with open(os.path.join(corpus_folder, "corpus.json")) as f:
+        corpus = json.load(f)
+    # Where the previews are saved
+    settings.jpg_previews = out_folder
+    settings.jpg_previews_free = None
+    settings.previews = True
+    results = []
+    for name in names:
+        if name == 'validate_md5':
+            size = sum(values['size_bytes'] for values in corpus)
+            res = run_measure(validate_md5_corpus, (corpus_folder,), repeat)
+            res.update({'function': name, 'file': "corpus.md5", 'size_bytes': size})
+            results.append(res)
+            continue
+        program = REQUIRED_PROGRAMS.get(name)
+        if program is not None and check_requirements(program()) is False:
+            results.append({'function': name, 'skipped': f"{program()} not found"})
+            continue
+        suffixes, func = FILE_FUNCTIONS[name]
+        for file_id, values in enumerate(corpus):
+            if os.path.splitext(values['file'])[1] not in suffixes:
+                continue
+            file_path = os.path.join(corpus_folder, values['file'])
+            res = run_measure(func, (file_path, out_folder, file_id), repeat)
+            res.update({'function': name, **values})
+            results.append(res)
+    for res in results:
+        if res.get('seconds'):
+            res['mb_s'] = res['size_bytes'] / res['seconds'] / 1e6
+    return results
+
+
+if __name__ == "__main__":
+    names = list(FILE_FUNCTIONS) + ['validate_md5']
+    parser = argparse.ArgumentParser(description="Time the checks on a synthetic corpus")
+    parser.add_argument('--corpus', help="Folder made by corpus.py, generated in a temp folder if not set")
+    parser.add_argument('--sizes', default="1,12", help="Sizes in megapixels when generating the corpus")
+    parser.add_argument('--functions', default=",".join(names), help="Functions to time, comma separated")
+    parser.add_argument('--repeat', type=int, default=1, help="Runs of each measurement, the best is kept")
+    parser.add_argument('--output', help="JSON file for the results, stdout if not set")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory(dir=os.environ.get('TMPDIR', '/tmp')) as tmp_folder:
+        corpus_folder = args.corpus
+        if corpus_folder is None:
+            corpus_folder = os.path.join(tmp_folder, "corpus")
+            make_corpus(corpus_folder, [int(mp) for mp in args.sizes.split(',')])
+        out_folder = os.path.join(tmp_folder, "previews")
+        os.makedirs(out_folder)
+        results = run(corpus_folder, args.functions.split(','), args.repeat, out_folder)
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+    for res in results:
+        if 'skipped' in res:
+            print(f"{res['function']:18} skipped: {res['skipped']}", file=sys.stderr)
+        elif 'error' in res:
+            print(f"{res['function']:18} {res['file']:32} error: {res['error']}", file=sys.stderr)
+        else:
+            print(f"{res['function']:18} {res['file']:32} {res['seconds']:8.3f} s {res['mb_s']:10.1f} MB/s "
+                  f"{res['peak_rss_kb'] / 1024:8.1f} MB", file=sys.stderr)
+    if args.output is None:
+        print(json.dumps(report, indent=1))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
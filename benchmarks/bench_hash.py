@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+#
+# Compare the hashing of files with 4K reads (the code before
+# functions.read_chunks) against read_chunks with several buffer sizes.
+#
+# Usage: python benchmarks/bench_hash.py [file_size_mb] [file]
+#
+import os
+import sys
+import json
+import time
+import hashlib
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from functions import file_digest
+
+
+def md5_4k(file_path):
+    """
+    MD5 as it was done in get_filemd5 and md5sum
+    """
+    md5_hash = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for byte_block in iter(lambda: f.read(4096), b""):
+            md5_hash.update(byte_block)
+    return md5_hash.hexdigest()
+
+
+def timed(func, *args, repeat=3):
+    """
+    Best time of `repeat` runs, the file is read once before so
+    all runs use the page cache
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return res, best
+
+
+def run(file_path):
+    file_size = os.path.getsize(file_path)
+    md5_4k(file_path)
+    results = []
+    expected, elapsed = timed(md5_4k, file_path)
+    results.append({'method': 'read(4096)', 'seconds': elapsed, 'mb_s': file_size / elapsed / 1e6})
+    for mb in (1, 4, 16):
+        for direct in (False, True):
+            digest, elapsed = timed(file_digest, file_path, 'md5', mb * 1024 * 1024, direct)
+            assert digest == expected
+            results.append({'method': f"read_chunks({mb} MB{', O_DIRECT' if direct else ''})",
+                            'seconds': elapsed, 'mb_s': file_size / elapsed / 1e6})
+    return {'file_size': file_size, 'results': results}
+
+
+if __name__ == "__main__":
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    if len(sys.argv) > 2:
+        report = run(sys.argv[2])
+    else:
+        with tempfile.NamedTemporaryFile(dir=os.environ.get('TMPDIR', '/tmp')) as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(1024 * 1024))
+            f.flush()
+            report = run(f.name)
+    for res in report['results']:
+        print(f"{res['method']:32} {res['seconds']:8.3f} s {res['mb_s']:10.1f} MB/s")
+    print(json.dumps(report))
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+#
+# Startup costs of the worker: import time of the modules (with
+# python -X importtime) and the seconds to start the pool of worker
+# processes of a folder, with their RSS and PSS, for each start method.
+#
+# Usage: python benchmarks/bench_startup.py [--workers 4] [--methods forkserver,fork,spawn]
+#                                           [--modules functions,osprey_worker] [--top 15]
+#                                           [--output results.json]
+#
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import settings
+import functions
+from bench_functions import git_commit
+
+
+def import_times(module, top):
+    """
+    Run python -X importtime to import module in a new interpreter.
+    Returns the total ms and the modules with the most time of their own.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+                         capture_output=True, text=True, cwd=ROOT, env=env)
+    modules = []
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(own) / 1000, int(cumulative) / 1000))
+    total = next((cumulative for name, own, cumulative in modules if name == module), None)
+    return {
+        'module': module,
+        'error': res.stderr.strip().splitlines()[-1] if res.returncode != 0 else None,
+        'total_ms': total,
+        'modules': len(modules),
+        'top_ms': [{'module': name, 'self_ms': own, 'cumulative_ms': cumulative}
+                   for name, own, cumulative in sorted(modules, key=lambda m: m[1], reverse=True)[:top]],
+    }
+
+
+def memory_kb(pid):
+    """
+    RSS and PSS of a process in KB, the PSS counts the pages shared
+    with other processes divided between them
+    """
+    values = {}
+    for file_name, keys in (('status', ('VmRSS',)), ('smaps_rollup', ('Pss',))):
+        try:
+            with open(f"/proc/{pid}/{file_name}") as f:
+                for line in f:
+                    key = line.split(':')[0]
+                    if key in keys:
+                        values[key] = int(line.split()[1])
+        except OSError:
+            pass
+    return values.get('VmRSS'), values.get('Pss')
+
+
+def worker_pid(_):
+    # Long enough for each worker to get a task
+    time.sleep(0.01)
+    return os.getpid()
+
+
+def pool_startup(method, workers):
+    """
+    Seconds until all the workers of a pool answer, the first time (with the
+    forkserver, it starts the server) and the second, as with each new folder
+    """
+    settings.pool_start_method = method
+    results = []
+    for run in ('first', 'second'):
+        start = time.perf_counter()
+        pool = functions.pool_context().Pool(workers, initializer=functions.decode_worker_init,
+                                             initargs=(0, "", functions.decode_check_stages(), None,
+                                                       functions.settings_values()))
+        # The workers run the initializer before the tasks
+        pids = set(pool.map(worker_pid, range(workers * 4), chunksize=1))
+        seconds = time.perf_counter() - start
+        memory = [memory_kb(p.pid) for p in pool._pool]
+        pool.close()
+        pool.join()
+        results.append({
+            'method': method,
+            'pool': run,
+            'workers': workers,
+            'workers_answered': len(pids),
+            'seconds': seconds,
+            'worker_rss_kb': max((rss for rss, pss in memory if rss is not None), default=None),
+            'worker_pss_kb': max((pss for rss, pss in memory if pss is not None), default=None),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time and pool startup of the worker")
+    parser.add_argument('--workers', type=int, default=4, help="Worker processes of the pool")
+    parser.add_argument('--methods', default="forkserver,fork,spawn", help="Start methods to compare")
+    parser.add_argument('--modules', default="functions,osprey_worker", help="Modules to time the import of")
+    parser.add_argument('--top', type=int, default=15, help="Slowest modules to list")
+    parser.add_argument('--output', help="JSON file for the results, stdout if not set")
+    args = parser.parse_args()
+    imports = [import_times(module, args.top) for module in args.modules.split(',')]
+    pools = []
+    for method in args.methods.split(','):
+        pools.extend(pool_startup(method, args.workers))
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'imports': imports,
+        'pools': pools,
+    }
+    for res in imports:
+        if res['error'] is not None:
+            print(f"import {res['module']:16} error: {res['error']}", file=sys.stderr)
+        else:
+            print(f"import {res['module']:16} {res['total_ms']:8.1f} ms ({res['modules']} modules)", file=sys.stderr)
+    for res in pools:
+        print(f"pool {res['method']:10} {res['pool']:6} {res['seconds']:6.3f} s, worker RSS "
+              f"{(res['worker_rss_kb'] or 0) / 1024:6.1f} MB, PSS {(res['worker_pss_kb'] or 0) / 1024:6.1f} MB",
+              file=sys.stderr)
+    if args.output is None:
+        print(json.dumps(report, indent=1))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+#
+# Generate a synthetic corpus of TIFF files with Pillow for the benchmarks:
+# sizes in megapixels, 8 and 16 bits, RGB and gray, LZW, deflate and
+# uncompressed, multi-page, corrupt files and .eip-like raw pairs, with an
+# md5 file and a corpus.json that describes each file.
+#
+# Usage: python benchmarks/corpus.py out_folder [--sizes 1,12,50,200]
+#
+import os
+import sys
+import math
+import json
+import struct
+import hashlib
+import zipfile
+import argparse
+
+from PIL import Image
+
+Image.MAX_IMAGE_PIXELS = None
+
+
+def image_size(megapixels):
+    """
+    Width and height of a 3:2 image with this many megapixels
+    """
+    width = int(math.sqrt(megapixels * 1e6 * 3 / 2))
+    return width, int(megapixels * 1e6 / width)
+
+
+def make_image(mode, size):
+    """
+    Image with noise over a gradient, so it compresses like a photograph
+    and not like a flat image. mode is 'RGB', 'L' or 'I;16'.
+    """
+    noise = Image.effect_noise(size, 32)
+    gradient = Image.linear_gradient('L').resize(size)
+    base = Image.blend(noise, gradient, 0.5)
+    if mode == 'L':
+        return base
+    if mode == 'I;16':
+        return base.convert('I').point(lambda v: v * 257).convert('I;16')
+    return Image.merge('RGB', (base, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT), noise))
+
+
+def write_rgb16_tiff(file_path, img, rows_per_strip=64):
+    """
+    Write an RGB image as an uncompressed 16 bits per sample TIFF,
+    which Pillow can not save. Each 8-bit value v is stored as v * 257.
+    """
+    width, height = img.size
+    no_strips = (height + rows_per_strip - 1) // rows_per_strip
+    strip_sizes = [min(rows_per_strip, height - i * rows_per_strip) * width * 6 for i in range(no_strips)]
+    # Header, IFD, then the arrays and the strips
+    entries = 12
+    ifd_size = 2 + entries * 12 + 4
+    bits_offset = 8 + ifd_size
+    res_offset = bits_offset + 6
+    offsets_offset = res_offset + 16
+    counts_offset = offsets_offset + 4 * no_strips
+    data_offset = counts_offset + 4 * no_strips
+    strip_offsets = []
+    offset = data_offset
+    for strip_size in strip_sizes:
+        strip_offsets.append(offset)
+        offset += strip_size
+    tags = [
+        (256, 4, 1, width),
+        (257, 4, 1, height),
+        (258, 3, 3, bits_offset),
+        (259, 3, 1, 1),
+        (262, 3, 1, 2),
+        (273, 4, no_strips, offsets_offset if no_strips > 1 else strip_offsets[0]),
+        (277, 3, 1, 3),
+        (278, 4, 1, rows_per_strip),
+        (279, 4, no_strips, counts_offset if no_strips > 1 else strip_sizes[0]),
+        (282, 5, 1, res_offset),
+        (283, 5, 1, res_offset + 8),
+        (284, 3, 1, 1),
+    ]
+    with open(file_path, 'wb') as f:
+        f.write(b'II' + struct.pack('<HL', 42, 8))
+        f.write(struct.pack('<H', entries))
+        for tag, field_type, count, value in tags:
+            if field_type == 3 and count == 1:
+                f.write(struct.pack('<HHLHH', tag, field_type, count, value, 0))
+            else:
+                f.write(struct.pack('<HHLL', tag, field_type, count, value))
+        f.write(struct.pack('<L', 0))
+        f.write(struct.pack('<HHH', 16, 16, 16))
+        f.write(struct.pack('<LLLL', 300, 1, 300, 1))
+        f.write(struct.pack(f'<{no_strips}L', *strip_offsets))
+        f.write(struct.pack(f'<{no_strips}L', *strip_sizes))
+        for i in range(no_strips):
+            rows = img.crop((0, i * rows_per_strip, width, i * rows_per_strip + strip_sizes[i] // (width * 6)))
+            data = rows.tobytes()
+            strip = bytearray(2 * len(data))
+            strip[0::2] = data
+            strip[1::2] = data
+            f.write(strip)
+
+
+def write_eip(file_path, raw_size):
+    """
+    A stand-in for a Phase One .eip file: a zip with a raw blob and its settings
+    """
+    with zipfile.ZipFile(file_path, 'w', zipfile.ZIP_STORED) as z:
+        z.writestr('raw.iiq', os.urandom(raw_size))
+        z.writestr('settings.xml', '<settings><camera>synthetic</camera></settings>')
+
+
+def corrupt(src, dst, kind):
+    """
+    Copy src to dst damaged: 'truncated' (half of the file), 'magic' (wrong
+    TIFF version) or 'ifd' (first IFD past the end of the file)
+    """
+    with open(src, 'rb') as f:
+        data = bytearray(f.read())
+    if kind == 'truncated':
+        data = data[:len(data) // 2]
+    elif kind == 'magic':
+        data[2:4] = b'\0\0'
+    elif kind == 'ifd':
+        struct.pack_into('<L', data, 4, len(data) + 1000)
+    with open(dst, 'wb') as f:
+        f.write(data)
+
+
+def make_corpus(out_folder, sizes=(1, 12), pages=3):
+    """
+    Generate the corpus in out_folder, returns the list of files with
+    their description, also saved in corpus.json
+    """
+    os.makedirs(out_folder, exist_ok=True)
+    files = []
+
+    def add(file_name, **values):
+        file_path = os.path.join(out_folder, file_name)
+        values.update({'file': file_name, 'size_bytes': os.path.getsize(file_path)})
+        files.append(values)
+        print(f"{file_name:40} {values['size_bytes'] / 1e6:10.1f} MB", file=sys.stderr)
+        return file_path
+
+    for megapixels in sizes:
+        size = image_size(megapixels)
+        rgb = make_image('RGB', size)
+        for compression, name in ((None, 'raw'), ('tiff_lzw', 'lzw'), ('tiff_adobe_deflate', 'deflate')):
+            file_name = f"rgb8_{name}_{megapixels}mp.tif"
+            rgb.save(os.path.join(out_folder, file_name), compression=compression)
+            add(file_name, variant=f"rgb8_{name}", megapixels=megapixels, valid=True)
+        file_name = f"rgb16_raw_{megapixels}mp.tif"
+        write_rgb16_tiff(os.path.join(out_folder, file_name), rgb)
+        add(file_name, variant="rgb16_raw", megapixels=megapixels, valid=True)
+        # Raw pair of the LZW file
+        file_name = f"rgb8_lzw_{megapixels}mp.eip"
+        write_eip(os.path.join(out_folder, file_name), size[0] * size[1] * 2)
+        add(file_name, variant="eip", megapixels=megapixels, valid=True)
+        del rgb
+        gray = make_image('L', size)
+        file_name = f"gray8_lzw_{megapixels}mp.tif"
+        gray.save(os.path.join(out_folder, file_name), compression='tiff_lzw')
+        add(file_name, variant="gray8_lzw", megapixels=megapixels, valid=True)
+        del gray
+        gray16 = make_image('I;16', size)
+        for compression, name in ((None, 'raw'), ('tiff_lzw', 'lzw')):
+            file_name = f"gray16_{name}_{megapixels}mp.tif"
+            gray16.save(os.path.join(out_folder, file_name), compression=compression)
+            add(file_name, variant=f"gray16_{name}", megapixels=megapixels, valid=True)
+        del gray16
+    # Multi-page and corrupt files, of the smallest size
+    megapixels = min(sizes)
+    size = image_size(megapixels)
+    file_name = f"rgb8_lzw_{pages}pages_{megapixels}mp.tif"
+    images = [make_image('RGB', size) for _ in range(pages)]
+    images[0].save(os.path.join(out_folder, file_name), compression='tiff_lzw', save_all=True, append_images=images[1:])
+    add(file_name, variant="multipage", megapixels=megapixels, valid=False)
+    del images
+    for kind in ('truncated', 'magic', 'ifd'):
+        file_name = f"corrupt_{kind}_{megapixels}mp.tif"
+        corrupt(os.path.join(out_folder, f"rgb8_lzw_{megapixels}mp.tif"), os.path.join(out_folder, file_name), kind)
+        add(file_name, variant=f"corrupt_{kind}", megapixels=megapixels, valid=False)
+    # md5 file of the folder
+    with open(os.path.join(out_folder, "corpus.md5"), 'w') as f:
+        for values in files:
+            md5_hash = hashlib.md5()
+            with open(os.path.join(out_folder, values['file']), 'rb') as data:
+                for chunk in iter(lambda: data.read(4 * 1024 * 1024), b""):
+                    md5_hash.update(chunk)
+            f.write(f"{md5_hash.hexdigest()}  {values['file']}\n")
+    with open(os.path.join(out_folder, "corpus.json"), 'w') as f:
+        json.dump(files, f, indent=1)
+    return files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic TIFF corpus")
+    parser.add_argument('out_folder')
+    parser.add_argument('--sizes', default="1,12",
+                        help="Sizes of the images in megapixels, comma separated (e.g. 1,12,50,200)")
+    parser.add_argument('--pages', type=int, default=3, help="Pages of the multi-page file")
+    args = parser.parse_args()
+    make_corpus(args.out_folder, [int(mp) for mp in args.sizes.split(',')], args.pages)
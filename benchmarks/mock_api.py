@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+#
+# Stand-in for the Osprey Dashboard API, to run the worker and load tests
+# without the real server. Implements the endpoints the worker uses, keeps
+# the projects, folders and files in memory, and can add latency and errors.
+# GET /_stats returns the count of requests by endpoint and type.
+#
+# Usage: python benchmarks/mock_api.py [--port 8999] [--latency 0.02] [--jitter 0.01]
+#                                      [--error-rate 0.01] [--error-status 503] [--drop-rate 0]
+#
+import re
+import json
+import time
+import random
+import argparse
+import itertools
+import threading
+from collections import Counter
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class MockDashboard(object):
+    """
+    State of the mock API: folders and files of each project, the checks
+    sent for each file and the accounting of the requests
+    """
+    def __init__(self, project_alias="test", project_checks="unique_file,tifpages,tif_compression",
+                 sys_ver="2.11.0", latency=0, jitter=0, error_rate=0, error_status=503, drop_rate=0, seed=None):
+        self.project_alias = project_alias
+        self.project_checks = project_checks
+        self.sys_ver = sys_ver
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        # Folders by folder_id, with their files by file_name
+        self.folders = {}
+        # Results of the checks, by (file_id, file_check)
+        self.filechecks = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.requests = Counter()
+            self.errors = Counter()
+            self.idempotency_keys = set()
+            self.repeated_keys = 0
+            self.bytes_in = 0
+            self.bytes_out = 0
+            self.latency_total = 0.0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'seconds': time.monotonic() - self.started,
+                'requests': sum(self.requests.values()),
+                'by_request': {key: value for key, value in sorted(self.requests.items())},
+                'errors_injected': dict(self.errors),
+                'repeated_idempotency_keys': self.repeated_keys,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'latency_added': self.latency_total,
+                'folders': len(self.folders),
+                'files': sum(len(folder['files']) for folder in self.folders.values()),
+                'filechecks': len(self.filechecks),
+            }
+
+    def folder_info(self, folder):
+        return {'folder_id': folder['folder_id'], 'folder': folder['folder'], 'folder_path': folder['folder_path'],
+                'delivered_to_dams': 9, 'qc_status': "QC Pending", 'status': folder['status'], 'file_errors': 0}
+
+    def project(self):
+        with self.lock:
+            return {'project_alias': self.project_alias, 'project_id': 1, 'transcription': 0,
+                    'project_checks': self.project_checks,
+                    'folders': [self.folder_info(folder) for folder in self.folders.values()]}
+
+    def new_file(self, folder_id, file_name):
+        file_id = next(self.ids)
+        self.folders[int(folder_id)]['files'][file_name] = file_id
+        return file_id
+
+    def new(self, data):
+        with self.lock:
+            if data.get('type') == 'folder':
+                folder_id = next(self.ids)
+                self.folders[folder_id] = {'folder_id': folder_id, 'folder': data.get('folder'),
+                                           'folder_path': data.get('folder_path'), 'status': 9, 'files': {}}
+                return {'result': [{'folder_id': folder_id}]}
+            if data.get('type') == 'file':
+                return {'result': [{'file_id': self.new_file(data['folder_id'], data['filename'])}]}
+            if data.get('type') == 'files':
+                return {'result': [{'file_id': self.new_file(data['folder_id'], values['filename']),
+                                    'file_name': values['filename']} for values in json.loads(data['files'])]}
+            return {'result': True}
+
+    def update(self, data):
+        with self.lock:
+            if data.get('property') == 'filechecks':
+                self.filechecks[(data.get('file_id'), data.get('file_check'))] = (data.get('value'), data.get('check_info'))
+            elif data.get('type') == 'filechecks':
+                for values in json.loads(data['checks']):
+                    self.filechecks[(str(values['file_id']), data.get('file_check'))] = (values['value'], values['check_info'])
+            elif data.get('property') == 'delete':
+                for folder in self.folders.values():
+                    folder['files'] = {name: file_id for name, file_id in folder['files'].items()
+                                       if str(file_id) != data.get('file_id')}
+            elif data.get('type') == 'folder' and data.get('property') == 'status0':
+                self.folders[int(data['folder_id'])]['status'] = 0
+            return {'result': True}
+
+    def folder(self, folder_id, data):
+        with self.lock:
+            folder = self.folders.get(folder_id)
+            if folder is None:
+                return None
+            files = [{'file_id': file_id, 'file_name': name} for name, file_id in folder['files'].items()]
+            if 'page' in data:
+                page_size = int(data['page_size'])
+                page = int(data['page'])
+                files = files[(page - 1) * page_size:page * page_size]
+            return dict(self.folder_info(folder), files=files)
+
+    def project_files(self):
+        with self.lock:
+            return [{'file_id': file_id, 'file_name': name, 'folder_id': folder['folder_id']}
+                    for folder in self.folders.values() for name, file_id in folder['files'].items()]
+
+    def handle(self, method, path, data):
+        """
+        Returns (status, response object)
+        """
+        if method == 'GET':
+            if path == '/_stats':
+                return 200, self.stats()
+            if path == '/':
+                return 200, {'sys_ver': self.sys_ver}
+            return 404, {'error': 'not found'}
+        if re.fullmatch(r'/projects/[^/]+/files', path):
+            return 200, self.project_files()
+        if re.fullmatch(r'/projects/[^/]+', path):
+            return 200, self.project()
+        match = re.fullmatch(r'/folders/(\d+)', path)
+        if match:
+            res = self.folder(int(match.group(1)), data)
+            return (404, {'error': 'folder not found'}) if res is None else (200, res)
+        if re.fullmatch(r'/new/[^/]+', path):
+            return 200, self.new(data)
+        if re.fullmatch(r'/update/[^/]+', path):
+            return 200, self.update(data)
+        return 404, {'error': 'not found'}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, method):
+        mock = self.server.mock
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length > 0 else b''
+        data = {key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()}
+        path = self.path.split('?')[0]
+        endpoint = re.sub(r'/\d+$', '/{id}', re.sub(r'^/(new|update|projects)/[^/]+', r'/\1/{alias}', path))
+        name = data.get('property') or data.get('type')
+        key = self.headers.get('Idempotency-Key')
+        with mock.lock:
+            if path != '/_stats':
+                mock.requests[f"{method} {endpoint}" + (f" {name}" if name else "")] += 1
+                mock.bytes_in += len(body)
+                if key is not None:
+                    if key in mock.idempotency_keys:
+                        mock.repeated_keys += 1
+                    mock.idempotency_keys.add(key)
+            delay = max(0, mock.latency + mock.random.uniform(-mock.jitter, mock.jitter)) if mock.latency > 0 else 0
+            mock.latency_total += delay
+            draw = mock.random.random()
+        if delay > 0:
+            time.sleep(delay)
+        if path != '/_stats':
+            if draw < mock.drop_rate:
+                with mock.lock:
+                    mock.errors['dropped'] += 1
+                # Close without a response
+                self.close_connection = True
+                return
+            if draw < mock.drop_rate + mock.error_rate:
+                with mock.lock:
+                    mock.errors[str(mock.error_status)] += 1
+                return self.send(mock.error_status, {'error': 'injected error'})
+        status, res = mock.handle(method, path, data)
+        self.send(status, res)
+
+    def send(self, status, obj):
+        data = json.dumps(obj).encode('utf-8')
+        with self.server.mock.lock:
+            self.server.mock.bytes_out += len(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+
+def serve(host="127.0.0.1", port=0, **options):
+    """
+    Start the mock API in a thread, port 0 to use a free port.
+    Returns the server, with the MockDashboard in server.mock and the url in server.url.
+    """
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.mock = MockDashboard(**options)
+    server.url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Osprey Dashboard API")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8999)
+    parser.add_argument('--project', default="test", help="Alias of the project")
+    parser.add_argument('--checks', default="unique_file,tifpages,tif_compression", help="project_checks of the project")
+    parser.add_argument('--version', default="2.11.0", help="sys_ver returned by /")
+    parser.add_argument('--latency', type=float, default=0, help="Seconds added to each request")
+    parser.add_argument('--jitter', type=float, default=0, help="Random seconds added to or removed from the latency")
+    parser.add_argument('--error-rate', type=float, default=0, help="Share of requests answered with --error-status")
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--drop-rate', type=float, default=0, help="Share of requests closed without a response")
+    parser.add_argument('--seed', type=int, help="Seed of the random latency and errors")
+    args = parser.parse_args()
+    server = serve(args.host, args.port, project_alias=args.project, project_checks=args.checks,
+                   sys_ver=args.version, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                   error_status=args.error_status, drop_rate=args.drop_rate, seed=args.seed)
+    print(f"Mock API at {server.url}, stats at {server.url}/_stats")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(json.dumps(server.mock.stats(), indent=1))
@@ -2,26 +2,42 @@
 from datetime import datetime
 import os
 import subprocess
-import xmltodict
+import signal
+import resource
 import sys
 import json
-import requests
-import pandas as pd
-from random import randint
+import io
+import xml.etree.ElementTree as ET
 import glob
 from PIL import Image
 from pathlib import Path
+from collections import Counter
 import shutil
 import locale
-import itertools
 import hashlib
-from multiprocessing import Pool
+import sqlite3
+import zlib
+import mmap
+import multiprocessing
+import multiprocessing.forkserver
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 # import pytesseract
 import tarfile
 import uuid 
+import logging
+import threading
+import time
+import queue
+from typing import Tuple, Any, NamedTuple, Callable
 
-# Zoom images
-import si_deepzoom as deepzoom
+# Structure of TIFF files
+from tiff_structure import tiff_problems
+# Requests to the API
+from api_client import send_request, get_records, FileInfo, ResultSubmitter, get_outbox
+# Timing of the stages
+from metrics import timed, folder_metrics
+# Logging from the worker processes
+from worker_logging import worker_logging_init, get_log_queue, gzip_namer, gzip_rotator, Truncated
 # Get settings and queries
 import settings
 
@@ -40,61 +56,133 @@ def check_requirements(program):
     return which(program) is not None
 
 
-def compress_log():
+class ProgramResult(NamedTuple):
     """
-    Compress log files
+    Result of an external program run with run_program
     """
-    filecheck_dir = os.path.dirname(__file__)
-    os.chdir(f"{filecheck_dir}/logs")
-    folders = []
-    files = []
-    for entry in os.scandir('.'):
-        if entry.is_dir():
-            folders.append(entry.path)
-        elif entry.is_file():
-            files.append(entry.path)
-    # No folders found
-    if len(folders) == 0:
-        return None
-    # Compress each folder
-    for folder in folders:
-        subprocess.run(["zip", "-r", f"{folder}.zip", folder])
-        shutil.rmtree(folder)
-    for file in files:
-        subprocess.run(["zip", f"{file}.zip", file])
-        shutil.rmtree(file)
-    os.chdir(filecheck_dir)
+    # None if the program was killed after the timeout
+    returncode: Any
+    out: bytes
+    err: bytes
+    seconds: float
+    timed_out: bool
+
+
+def run_program(name, args, env=None, timeout=None):
+    """
+    Run an external program, args is the argv list (no shell). name is the key of the
+    program in settings.tool_timeouts, env has the variables to add to the environment.
+    The program is killed, with any programs it started, after the timeout and
+    runs with the limits of settings.tool_cpu_limit (seconds) and
+    settings.tool_memory_limit (bytes). Waits for a free slot of
+    settings.tool_processes before starting.
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'tool_timeouts', {}).get(name)
+    if env is not None:
+        env = dict(os.environ, **env)
+    limits = []
+    cpu_limit = getattr(settings, 'tool_cpu_limit', None)
+    if cpu_limit is not None:
+        limits.append((resource.RLIMIT_CPU, (cpu_limit, cpu_limit)))
+    memory_limit = getattr(settings, 'tool_memory_limit', None)
+    if memory_limit is not None:
+        limits.append((resource.RLIMIT_AS, (memory_limit, memory_limit)))
+    _get_tool_executor()
+    with _tool_slots, timed(f"program:{name}"):
+        start = time.perf_counter()
+        # In its own session to kill the whole group on timeout
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
+                             start_new_session=True)
+        # Set after the start instead of with preexec_fn, which is not safe with threads
+        for limit, values in limits:
+            try:
+                resource.prlimit(p.pid, limit, values)
+            except (OSError, ValueError):
+                pass
+        timed_out = False
+        try:
+            (out, err) = p.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            (out, err) = p.communicate()
+        seconds = time.perf_counter() - start
+    logger = logging.getLogger("osprey")
+    if timed_out:
+        logger.error(f"{name} killed after {timeout} s: {args}")
+        return ProgramResult(None, out, err, seconds, True)
+    logger.debug("%s ran in %.3f s (exit %s): %s", name, seconds, p.returncode, args)
+    return ProgramResult(p.returncode, out, err, seconds, False)
+
+
+def compress_log(logfile=None):
+    """
+    Compress the folders in logs and the log file of this run,
+    the rotated log files are compressed when they are rotated
+    """
+    log_folder = f"{os.path.dirname(os.path.abspath(__file__))}/logs"
+    if os.path.isdir(log_folder):
+        for entry in os.scandir(log_folder):
+            if entry.is_dir():
+                shutil.make_archive(entry.path, 'zip', log_folder, entry.name)
+                shutil.rmtree(entry.path)
+    if logfile is not None and os.path.isfile(logfile):
+        gzip_rotator(logfile, gzip_namer(logfile))
     return True
 
 
-def send_request(url, payload, logger, log_res = True):
+# Children of repInfo up to the messages, the ones after (properties
+# has the dump of the IFDs) are not read
+JHOVE_REPORT_TAGS = {'uri', 'reportingModule', 'lastModified', 'size', 'format', 'version',
+                     'status', 'sigMatch', 'messages'}
+
+
+def jhove_report(xml):
     """
-    Execute request to API
+    Get the status and the messages of the first repInfo in the XML output of
+    JHOVE, parsing it in chunks and stopping after the messages
     """
-    try:
-        logger.info(f"send_request: {url}|{payload}")        
-        r = requests.post(url, data=payload)
-        results = json.loads(r.text.encode('utf-8'))
-        if r.status_code == 200:
-            if log_res:
-                logger.info(f"send_request_res: {results}")
-            return results
-        else:
-            logger.error(f"send_request: {url}|{payload}|{r.headers}")
-            return False
-    except:
-        logger.error(f"send_request: {url}|{payload}|{r.headers}")
-        return False
+    parser = ET.XMLPullParser(events=('start', 'end'))
+
+    def events():
+        for offset in range(0, len(xml), 65536):
+            parser.feed(xml[offset:offset + 65536])
+            yield from parser.read_events()
+        parser.close()
+        yield from parser.read_events()
+
+    file_status = None
+    messages = []
+    # Tags of the open elements, without the namespace
+    path = []
+    for event, elem in events():
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if event == 'start':
+            if path[-1:] == ['repInfo'] and tag not in JHOVE_REPORT_TAGS:
+                # No messages (a valid file), or past them
+                break
+            path.append(tag)
+            continue
+        path.pop()
+        if tag == 'status' and path[-1:] == ['repInfo']:
+            file_status = elem.text
+        elif tag == 'message' and path[-2:] == ['repInfo', 'messages']:
+            messages.append(elem.text or "")
+        elif (tag == 'messages' and path[-1:] == ['repInfo']) or tag == 'repInfo':
+            break
+        # Drop the elements already read
+        elem.clear()
+    return file_status, messages
 
 
 def jhove_validate(file_path):
     """
     Validate the file with JHOVE
     """
-    # Where to write the results
-    xml_file = f"{settings.tmp_folder}/jhove_{randint(100, 100000)}.xml"
-    if os.path.isfile(xml_file):
-        os.unlink(xml_file)
     file_suffix = Path(file_path).suffix
     if file_suffix.lower() == ".tif":
         jhove_module = "TIFF-hul"
@@ -107,68 +195,42 @@ def jhove_validate(file_path):
     else:
         jhove_module = "BYTESTREAM"
         # return 1, "Unknown file type"
-    p = subprocess.Popen([settings.jhove, "-h", "xml", "-o", xml_file, "-m", jhove_module, file_path],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    (out, err) = p.communicate()
-    # Open and read the results xml
+    # Results in XML to stdout
+    res = run_program('jhove', [settings.jhove, "-h", "xml", "-m", jhove_module, file_path])
+    if res.timed_out:
+        return 1, f"JHOVE did not finish in {res.seconds:.0f} s"
     try:
-        with open(xml_file) as fd:
-            doc = xmltodict.parse(fd.read())
-    except Exception as e:
-        # Try again
-        if os.path.isfile(xml_file):
-            os.unlink(xml_file)
-        p = subprocess.Popen([settings.jhove, "-h", "xml", "-o", xml_file, "-m", jhove_module, file_path],
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        (out, err) = p.communicate()
-        # Open and read the results xml
-        try:
-            with open(xml_file) as fd:
-                doc = xmltodict.parse(fd.read())
-        except Exception as e:
-            error_msg = f"Could not find result file from JHOVE ({xml_file}) ({e}) | {out} - {err}"
-            check_results = 1
-            check_info = error_msg
-            return check_results, check_info
-    if os.path.isfile(xml_file):
-        os.unlink(xml_file)
-    # Get file status
-    file_status = doc['jhove']['repInfo']['status']
-    jhove_results = out.decode('latin-1')
+        file_status, messages = jhove_report(res.out)
+    except ET.ParseError as e:
+        file_status = None
+        error_msg = e
+    else:
+        error_msg = "no status found"
+    if file_status is None:
+        check_results = 1
+        check_info = f"Could not read the results of JHOVE ({error_msg}) | {res.err.decode('latin-1')}"
+        return check_results, check_info
     if file_status == "Well-Formed and valid":
         check_results = 0
-        check_info = jhove_results
+        check_info = file_status
     else:
         check_results = 1
+        jhove_status = file_status
         # If the only error is with the WhiteBalance, ignore
         # Issue open at Github, seems will be fixed in future release
         # https://github.com/openpreserve/jhove/issues/364
-        if type(doc['jhove']['repInfo']['messages']['message']) is dict:
+        if len(messages) == 1:
             # Single message
-            if doc['jhove']['repInfo']['messages']['message']['#text'][:31] == "WhiteBalance value out of range":
+            file_status = messages[0]
+            if messages[0][:31] == "WhiteBalance value out of range":
                 check_results = 0
-                file_status = doc['jhove']['repInfo']['messages']['message']['#text']
-            elif doc['jhove']['repInfo']['messages']['message']['#text'][:20] == "Unknown TIFF IFD tag":
+            elif messages[0][:20] == "Unknown TIFF IFD tag":
                 check_results = 0
-                file_status = doc['jhove']['repInfo']['messages']['message']['#text']
-            else:
-                check_results = 1
-                check_info = jhove_results
-                file_status = doc['jhove']['repInfo']['messages']['message']['#text']
-        else:
-            if len(doc['jhove']['repInfo']['messages']['message']) == 2:
-                if doc['jhove']['repInfo']['messages']['message'][0]['#text'][:20] == "Unknown TIFF IFD tag" and doc['jhove']['repInfo']['messages']['message'][1]['#text'][:31] == "WhiteBalance value out of range":
-                    check_results = 0
-                    f_stat = []
-                    for msg in doc['jhove']['repInfo']['messages']['message']:
-                        f_stat.append(msg['#text'])
-                    file_status = ", ".join(f_stat)
-            else:
-                check_results = 1
-                check_info = jhove_results
-        check_info = f"{file_status}; {jhove_results}"
+        elif len(messages) == 2:
+            if messages[0][:20] == "Unknown TIFF IFD tag" and messages[1][:31] == "WhiteBalance value out of range":
+                check_results = 0
+                file_status = ", ".join(messages)
+        check_info = f"{file_status}; {jhove_status}"
     return check_results, check_info
 
 
@@ -176,28 +238,20 @@ def magick_validate(filename, paranoid=False):
     """
     Validate the file with Imagemagick
     """
-    try:
-        settings.magick_limit
-    except NameError:
-        magick_limit = ""
-    else:
-        magick_limit = "MAGICK_THREAD_LIMIT={settings.magick_limit}"
+    args = ['identify' if settings.magick is None else settings.magick, '-verbose']
     if paranoid:
-        if settings.magick is None:
-            p = subprocess.Popen([magick_limit, 'identify', '-verbose', '-regard-warnings', filename], stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE, shell=True)
-        else:
-            p = subprocess.Popen([magick_limit, settings.magick, '-verbose', '-regard-warnings', filename], stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE, shell=True)
-    else:
-        if settings.magick is None:
-            p = subprocess.Popen([magick_limit, 'identify', '-verbose', filename], stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE, shell=True)
-        else:
-            p = subprocess.Popen([magick_limit, settings.magick, '-verbose', filename], stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE, shell=True)
-    (out, err) = p.communicate()
-    if p.returncode == 0:
+        args.append('-regard-warnings')
+    args.append(filename)
+    # Limit the threads of each Imagemagick process
+    env = None
+    magick_limit = getattr(settings, 'magick_limit', None)
+    if magick_limit is not None:
+        env = {'MAGICK_THREAD_LIMIT': str(magick_limit)}
+    res = run_program('magick', args, env=env)
+    if res.timed_out:
+        return 1, f"Imagemagick did not finish in {res.seconds:.0f} s"
+    (out, err) = (res.out, res.err)
+    if res.returncode == 0:
         check_results = 0
     else:
         check_results = 1
@@ -206,76 +260,85 @@ def magick_validate(filename, paranoid=False):
     return check_results, check_info
 
 
-def check_sequence(filename, project_files, sequence, sequence_split):
-    filename_stem = Path(filename).stem
-    file_id = None
-    for file in project_files:
-        if file['file_name'] == filename_stem:
-            file_id = file['file_id']
-            file_info = file
-            break
-    if file_id is None:
-        # Something is wrong
-        check_results = 1
-        check_info = f"file_id not found for {filename}"
-        return (file_id, check_results, check_info)
-    file_suffix = filename_stem.split(sequence_split)
-    file_wo_suffix = file_suffix[0:len(file_suffix) - 1]
-    file_wo_suffix = '_'.join(file_wo_suffix)
-    file_suffix = file_suffix[len(file_suffix) - 1]
-    # Found last in sequence
-    if file_suffix == sequence[len(sequence) - 1]:
-        # End of sequence
-        check_results = 0
-        check_info = "File is the first one in the sequence"
-        return (file_id, check_results, check_info)
-    for i in range(len(sequence)):
-        if file_suffix == sequence[i]:
-            next_in_seq = sequence[i + 1]
-            next_filename_stem = "{}{}{}".format(file_wo_suffix, sequence_split, next_in_seq)
-            for file in project_files:
-                if file['file_name'] == next_filename_stem:
-                    check_results = 0
-                    check_info = f"Next file in sequence ({next_filename_stem}) found"
-                    return (file_id, check_results, check_info)
-    check_results = 1
-    check_info = "Next file in sequence was not found"
-    return (file_id, check_results, check_info)
-
-
-def sequence_validate(filename, folder_id, project_files):
-    """
-    Validate that a suffix sequence is not missing items
-    """
-    sequence = settings.sequence
-    sequence_split = settings.sequence_split
-    file_id, check_results, check_info = check_sequence(filename, project_files, sequence, sequence_split)
-    file_check = 'sequence'
-    payload = {'type': 'file',
-               'property': 'filechecks',
-               'folder_id': folder_id,
-               'file_id': file_id,
-               'api_key': settings.api_key,
-               'file_check': file_check,
-               'value': check_results,
-               'check_info': check_info
-               }
-    r = requests.post(f"{settings.api_url}/update/{settings.project_alias}", data=payload)
-    query_results = json.loads(r.text.encode('utf-8'))
-    if query_results["result"] is not True:
-        return False
-    return True
+def check_sequences(stems, sequence, sequence_split):
+    """
+    Check that the next file in the sequence exists for each file, in the
+    files of a folder. The stems are grouped by the prefix before the last
+    sequence_split, each group is compared with the sequence as a set.
+    Returns a dict of (check_results, check_info) by stem.
+    """
+    # Suffixes found, by prefix
+    groups = {}
+    for stem in stems:
+        prefix, _, suffix = stem.rpartition(sequence_split)
+        groups.setdefault(prefix, set()).add(suffix)
+    # Next suffix in the sequence, for all but the last
+    next_suffix = dict(zip(sequence[:-1], sequence[1:]))
+    last_suffix = sequence[-1] if len(sequence) > 0 else None
+    results = {}
+    for prefix, suffixes in groups.items():
+        # Files where the next in the sequence is in the folder
+        next_found = {suffix for suffix in suffixes & next_suffix.keys() if next_suffix[suffix] in suffixes}
+        for suffix in suffixes:
+            stem = f"{prefix}{sequence_split}{suffix}" if prefix != "" else suffix
+            if suffix == last_suffix:
+                # End of sequence
+                results[stem] = (0, "File is the first one in the sequence")
+            elif suffix in next_found:
+                results[stem] = (0, f"Next file in sequence ({prefix}{sequence_split}{next_suffix[suffix]}) found")
+            else:
+                results[stem] = (1, "Next file in sequence was not found")
+    return results
 
 
-def tif_compression(file_path: str) -> tuple:
+def submit_sequences(ctx, files, logger, submitter):
+    """
+    Run the sequence check on the files of a folder and send the results in
+    a single request if settings.bulk_filechecks is True, or in a job for each
+    file, so the submitter threads send them in parallel
+    """
+    results = check_sequences([record.stem for record in files], settings.sequence, settings.sequence_split)
+    checks = []
+    for stem, (check_results, check_info) in results.items():
+        if stem not in ctx.folder_files:
+            logger.error(f"file_id not found for {stem}, sequence not checked")
+            continue
+        checks.append((stem, ctx.folder_files[stem].file_id, check_results, check_info))
+    url = f"{settings.api_url}/update/{settings.project_alias}"
+    if getattr(settings, 'bulk_filechecks', False):
+        payload = {'type': 'filechecks',
+                   'folder_id': ctx.folder_id,
+                   'api_key': settings.api_key,
+                   'file_check': 'sequence',
+                   'checks': json.dumps([{'file_id': file_id, 'value': check_results, 'check_info': check_info}
+                                         for stem, file_id, check_results, check_info in checks])
+                   }
+        submitter.submit('sequence', [(url, payload, False)])
+    else:
+        for stem, file_id, check_results, check_info in checks:
+            submitter.submit(f"sequence of {stem}", [(url, {'type': 'file',
+                                                           'property': 'filechecks',
+                                                           'folder_id': ctx.folder_id,
+                                                           'file_id': file_id,
+                                                           'api_key': settings.api_key,
+                                                           'file_check': 'sequence',
+                                                           'value': check_results,
+                                                           'check_info': check_info
+                                                           }, True)])
+    logger.info(f"Sequence results of {len(checks)} files in folder {ctx.folder_id}")
+
+
+def tif_compression(file_path: str, img=None) -> tuple:
     """
     Check if a TIFF file uses lossless compression.
+    img is the file already opened with Pillow, if any.
     Returns (0, compression_name) on success, (1, error_message) on failure.
     """
-    try:
-        img = Image.open(file_path)
-    except Exception as e:
-        return 1, f"File opening error: {file_path} - {e}"
+    if img is None:
+        try:
+            img = Image.open(file_path)
+        except Exception as e:
+            return 1, f"File opening error: {file_path} - {e}"
 
     # Pillow reports compression as a string (e.g., 'tiff_lzw', 'tiff_adobe_deflate')
     try:
@@ -344,14 +407,16 @@ def tif_compression(file_path: str) -> tuple:
 
 
 
-def tifpages(file_path: str) -> Tuple[int, Any]:
+def tifpages(file_path: str, img=None) -> Tuple[int, Any]:
     """
-    Check if TIF has multiple pages using Pillow
+    Check if TIF has multiple pages using Pillow,
+    img is the file already opened with Pillow, if any
     """
-    try:
-        img = Image.open(file_path)
-    except Exception as e:
-        return 1, f"File opening error: {file_path} - {e}"
+    if img is None:
+        try:
+            img = Image.open(file_path)
+        except Exception as e:
+            return 1, f"File opening error: {file_path} - {e}"
 
     try:
         no_pages = img.n_frames
@@ -371,24 +436,152 @@ def get_file_exif(filename):
     """
     Extract the EXIF info from the RAW file
     """
-    p = subprocess.Popen([settings.exiftool, '-j', '-L', '-a', '-U', '-u', '-D', '-G1', filename],
-                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (out, err) = p.communicate()
-    exif_info = out
+    res = run_program('exiftool', [settings.exiftool, '-j', '-L', '-a', '-U', '-u', '-D', '-G1', filename])
+    if res.timed_out:
+        return None
+    exif_info = res.out
     return exif_info
 
 
+# Threads that wait for the external programs, and the semaphore that caps
+# how many of them run at the same time in all the threads of the worker
+_tool_executor = None
+_tool_slots = None
+_tool_lock = threading.Lock()
+
+
+def _get_tool_executor():
+    global _tool_executor, _tool_slots
+    with _tool_lock:
+        if _tool_executor is None:
+            tool_processes = getattr(settings, 'tool_processes', os.cpu_count() or 2)
+            _tool_slots = threading.BoundedSemaphore(tool_processes)
+            _tool_executor = ThreadPoolExecutor(tool_processes * 2, thread_name_prefix="tool")
+    return _tool_executor
+
+
+def start_tool(func, *args):
+    """
+    Call func, a function that runs an external program, in the background.
+    Returns a Future.
+    """
+    return _get_tool_executor().submit(func, *args)
+
+
+# Read buffer of each thread that hashes files, reused between files
+_read_buffers = threading.local()
+
+
+def read_chunks(file_path, buffer_size=None, direct=None):
+    """
+    Read a file in large chunks into a reused buffer, yields a memoryview
+    of each chunk that is only valid until the next one.
+    buffer_size defaults to settings.hash_buffer, direct to settings.hash_direct
+    (read with O_DIRECT, bypassing the page cache, if the filesystem allows it).
+    """
+    if buffer_size is None:
+        buffer_size = getattr(settings, 'hash_buffer', 4 * 1024 * 1024)
+    if direct is None:
+        direct = getattr(settings, 'hash_direct', False)
+    # O_DIRECT reads must be multiples of the block size
+    buffer_size = max(4096, buffer_size - buffer_size % 4096)
+    buf = getattr(_read_buffers, 'buf', None)
+    if buf is None or len(buf) != buffer_size:
+        # Anonymous mmap memory is page-aligned, as O_DIRECT requires
+        buf = mmap.mmap(-1, buffer_size)
+        _read_buffers.buf = buf
+    view = memoryview(buf)
+    fd = None
+    if direct and hasattr(os, 'O_DIRECT'):
+        try:
+            fd = os.open(file_path, os.O_RDONLY | os.O_DIRECT)
+        except OSError:
+            # Not supported by the filesystem
+            fd = None
+    if fd is None:
+        fd = os.open(file_path, os.O_RDONLY)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    try:
+        with open(fd, 'rb', buffering=0, closefd=False) as f:
+            while True:
+                n = f.readinto(view)
+                if not n:
+                    break
+                yield view[:n]
+    finally:
+        os.close(fd)
+
+
+def file_digest(file_path, algorithm='md5', buffer_size=None, direct=None):
+    """
+    Get the hash of a file, as hex
+    """
+    file_hash = hashlib.new(algorithm)
+    for chunk in read_chunks(file_path, buffer_size, direct):
+        file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class CRC32(object):
+    """
+    CRC-32 with the interface of the hashlib objects
+    """
+    def __init__(self):
+        self.crc = 0
+
+    def update(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+
+    def hexdigest(self):
+        return format(self.crc, '08x')
+
+
+# Threads to update several hashes of the same chunk at once,
+# hashlib and zlib release the GIL for large buffers
+_digest_executor = None
+_digest_executor_lock = threading.Lock()
+
+
+def _get_digest_executor():
+    global _digest_executor
+    with _digest_executor_lock:
+        if _digest_executor is None:
+            _digest_executor = ThreadPoolExecutor(getattr(settings, 'hash_workers', 4),
+                                                  thread_name_prefix="digest")
+    return _digest_executor
+
+
+def file_digests(file_path, algorithms=None, buffer_size=None, direct=None):
+    """
+    Get several hashes of a file reading it once, returns a dict of hex
+    digests by algorithm. algorithms defaults to settings.hash_algorithms,
+    any name in hashlib or 'crc32'; md5 is always included.
+    """
+    if algorithms is None:
+        algorithms = getattr(settings, 'hash_algorithms', ['md5'])
+    algorithms = ['md5'] + [algorithm for algorithm in algorithms if algorithm != 'md5']
+    hashers = [CRC32() if algorithm == 'crc32' else hashlib.new(algorithm) for algorithm in algorithms]
+    if len(hashers) == 1:
+        for chunk in read_chunks(file_path, buffer_size, direct):
+            hashers[0].update(chunk)
+    else:
+        executor = _get_digest_executor()
+        for chunk in read_chunks(file_path, buffer_size, direct):
+            # The chunk is valid until the next read, wait for all the hashes
+            futures = [executor.submit(hasher.update, chunk) for hasher in hashers[1:]]
+            hashers[0].update(chunk)
+            for future in futures:
+                future.result()
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in zip(algorithms, hashers)}
+
+
 def get_filemd5(filepath, logger):
     """
     Get MD5 hash of a file
     """
-    md5_hash = hashlib.md5()
     if os.path.isfile(filepath):
-        with open(filepath, "rb") as f:
-            # Read and update hash in chunks of 4K
-            for byte_block in iter(lambda: f.read(4096), b""):
-                md5_hash.update(byte_block)
-        file_md5 = md5_hash.hexdigest()
+        file_md5 = file_digest(filepath)
     else:
         return False
     return file_md5
@@ -396,16 +589,11 @@ def get_filemd5(filepath, logger):
 
 def file_pair_check(filename, raw_files):
     """
-    Check if a file has a pair (main + raw)
+    Check if a file has a pair (main + raw), raw_files is a dict of
+    the raw FileRecord by stem
     """
-    file_stem = Path(filename).stem
-    # Check if file pair is present
-    pair_files = []
-    for rfile in raw_files:
-        if file_stem == Path(rfile).stem:
-            # Raw found
-            pair_files.append(rfile)
-    return pair_files
+    file_stem = os.path.splitext(os.path.basename(filename))[0]
+    return raw_files.get(file_stem, [])
 
 
 def jpgpreview(file_id, folder_id, file_path, logger):
@@ -495,7 +683,8 @@ def jpgpreview_zoom(file_id, folder_id, file_path, logger):
     # Create subfolder if it doesn't exists
     os.makedirs(preview_file_path, exist_ok=True)
     os.makedirs(zoom_folder, exist_ok=True)
-    # deepzoom
+    # deepzoom, imported on first use
+    import si_deepzoom as deepzoom
     creator = deepzoom.ImageCreator(tile_size=254,
                            tile_format='jpg',
                            image_quality=1.0,
@@ -516,71 +705,184 @@ def jpgpreview_zoom(file_id, folder_id, file_path, logger):
     return True
 
 
+# Status of each file when comparing the folder with the md5 files
+MD5_OK = "ok"
+MD5_MISMATCH = "mismatch"
+MD5_MISSING_ON_DISK = "missing-on-disk"
+MD5_MISSING_IN_MANIFEST = "missing-in-manifest"
+MD5_DUPLICATE = "duplicate"
+
+MD5_STATUS_MSG = {
+    MD5_MISMATCH: "Files Don't Match MD5 File",
+    MD5_MISSING_ON_DISK: "in MD5 file but not in folder",
+    MD5_MISSING_IN_MANIFEST: "in folder but not in MD5 file",
+    MD5_DUPLICATE: "duplicated",
+}
+
+
+def read_md5_file(md5_file):
+    """
+    Read a file in md5sum format, returns a list of (md5, file name)
+    """
+    entries = []
+    with open(md5_file, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if line == "":
+                continue
+            fields = line.split(None, 1)
+            if len(fields) == 1:
+                entries.append((fields[0], ""))
+                continue
+            md5_hash, file_name = fields
+            # md5sum marks binary mode with a * before the name
+            file_name = file_name.lstrip("*").replace("\\", "/")
+            entries.append((md5_hash, file_name.split("/")[-1]))
+    return entries
+
+
 def md5sum(md5_hashes, file):
-    # https://stackoverflow.com/a/7829658
-    filename = Path(file).name
-    md5_hash = hashlib.md5()
-    with open(file, "rb") as f:
-        # Read and update hash in chunks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
-            md5_hash.update(byte_block)
-    file_md5 = md5_hash.hexdigest()
-    try:
-        md5_from_file = md5_hashes.loc[md5_hashes['file'] == filename, 'md5'].item()
-    except ValueError:
-        try:
-            md5_from_file = md5_hashes.loc[md5_hashes['filename'] == filename, 'md5'].item()
-        except ValueError:
-            # An error getting or matching the value
-            return 1
-    try:
-        if file_md5.upper() == md5_from_file.upper():
-            return 0
-        elif md5_from_file == 'Series([], )':
-            return 1
-        else:
-            return 1
-    except AttributeError:
+    """
+    Compare the MD5 of a file with the one in md5_hashes, a dict by file name
+    """
+    md5_from_file = md5_hashes.get(os.path.basename(file))
+    if md5_from_file is None:
         return 1
+    file_md5 = file_digest(file)
+    if file_md5.upper() == md5_from_file.upper():
+        return 0
+    else:
+        return 1
+
+
+# Network filesystems, inotify does not see the changes made by other hosts
+REMOTE_FS = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'fuse.sshfs', 'lustre', 'gpfs', 'ceph'}
+
+
+def fs_type(path):
+    """
+    Type of the filesystem of a path, from /proc/mounts
+    """
+    path = os.path.realpath(path)
+    found, found_type = "", None
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                mount_point = fields[1].replace("\\040", " ")
+                if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) \
+                        and len(mount_point) >= len(found):
+                    found, found_type = mount_point, fields[2]
+    except OSError:
+        return None
+    return found_type
+
 
+def md5_workers(path):
+    """
+    Threads to hash the files of a folder: settings.md5_workers, or by the
+    type of storage if it is None. Network filesystems are limited by
+    latency, so more reads at once help; local disks by the CPU.
+    """
+    workers = getattr(settings, 'md5_workers', None)
+    if workers is not None:
+        return workers
+    if fs_type(path) in REMOTE_FS:
+        return 16
+    return os.cpu_count() or 4
 
-def check_md5(md5_hashes, files):
+
+def check_md5(md5_hashes, files, logger=None):
     """
     Compare hashes between files and what the md5 file says
-    :param md5_file:
-    :param files:
-    :return:
-    """
-    inputs = zip(itertools.repeat(md5_hashes), files)
-    with Pool(settings.no_workers) as pool:
-        bad_files = pool.starmap(md5sum, inputs)
-        pool.close()
-        pool.join()
-    if sum(bad_files) > 0:
-        return 1, f"{sum(bad_files)} Files Don't Match MD5 File"
-    else:
-        return 0, 0
+    :param md5_hashes: dict of the md5 by file name
+    :param files: list of FileRecord
+    :return: dict of the status (MD5_OK or MD5_MISMATCH) by file name
+    """
+    if logger is None:
+        logger = logging.getLogger("osprey")
+    results = {}
+    if len(files) == 0:
+        return results
+    no_files = len(files)
+    stop_on_error = getattr(settings, 'md5_stop_on_error', False)
+    done_bytes = 0
+    start_time = time.monotonic()
+    # Threads, hashlib releases the GIL
+    executor = ThreadPoolExecutor(md5_workers(os.path.dirname(files[0].path)), thread_name_prefix="md5")
+    try:
+        futures = {executor.submit(md5sum, md5_hashes, record.path): record for record in files}
+        for future in as_completed(futures):
+            record = futures[future]
+            res = future.result()
+            results[record.name] = MD5_OK if res == 0 else MD5_MISMATCH
+            done_bytes += record.size
+            logger.debug("md5 %s/%s: %s %s", len(results), no_files, record.path, results[record.name])
+            if res != 0 and stop_on_error:
+                # One mismatch is enough for the folder status
+                for pending in futures:
+                    pending.cancel()
+                break
+    finally:
+        executor.shutdown(wait=True)
+    elapsed = time.monotonic() - start_time
+    logger.info(f"md5 of {len(results)}/{no_files} files, {round(done_bytes / 1e6, 1)} MB in {round(elapsed, 1)} s "
+                f"({round(done_bytes / 1e6 / max(elapsed, 0.001), 1)} MB/s)")
+    return results
 
 
-def validate_md5(md5_files, files):
+def reconcile_md5(md5_files, files, logger=None):
     """
-    Check if the MD5 files are valid
+    Compare the files in the folder with the entries of the md5 files.
+    Every name gets one status: MD5_OK, MD5_MISMATCH, MD5_MISSING_ON_DISK,
+    MD5_MISSING_IN_MANIFEST or MD5_DUPLICATE (listed more than once in the
+    md5 files, or in more than one subfolder). Only the files with a single
+    entry are hashed, all in one pass.
+    Returns a dict of the status by file name.
     """
-    md5_hashes = pd.DataFrame(columns=['md5', 'file'])
+    entries = []
     for md5f in md5_files:
-        # Read md5 file
-        read_md5 = pd.read_csv(md5f, sep=r'\s+', header=None, names=['md5', 'file'])
-        md5_hashes = pd.concat([md5_hashes, read_md5], ignore_index=True, sort=False)
-    if len(files) != md5_hashes.shape[0]:
-        exit_msg = f"No. of files ({len(files)}) mismatch MD5 file ({md5_hashes.shape[0]})"
-        return 1, exit_msg
-    md5_hashes['filename'] = md5_hashes.apply(lambda row: Path(row.file).name, axis=1)
-    res, results = check_md5(md5_hashes, files)
-    if res == 0:
+        entries.extend(read_md5_file(md5f))
+    manifest_count = Counter(file_name for md5_hash, file_name in entries)
+    md5_hashes = {file_name: md5_hash for md5_hash, file_name in entries}
+    disk_count = Counter(record.name for record in files)
+    status = {}
+    for file_name in manifest_count.keys() | disk_count.keys():
+        if manifest_count[file_name] > 1 or disk_count[file_name] > 1:
+            status[file_name] = MD5_DUPLICATE
+        elif disk_count[file_name] == 0:
+            status[file_name] = MD5_MISSING_ON_DISK
+        elif manifest_count[file_name] == 0:
+            status[file_name] = MD5_MISSING_IN_MANIFEST
+    to_hash = [record for record in files if record.name not in status]
+    status.update(check_md5(md5_hashes, to_hash, logger))
+    return status
+
+
+def validate_md5(md5_files, files, logger=None):
+    """
+    Check if the MD5 files are valid, files is a list of FileRecord
+    """
+    if logger is None:
+        logger = logging.getLogger("osprey")
+    status = reconcile_md5(md5_files, files, logger)
+    by_status = {}
+    for file_name in sorted(status):
+        by_status.setdefault(status[file_name], []).append(file_name)
+    errors = []
+    for file_status in (MD5_MISMATCH, MD5_MISSING_ON_DISK, MD5_MISSING_IN_MANIFEST, MD5_DUPLICATE):
+        if file_status in by_status:
+            file_names = by_status[file_status]
+            logger.error(f"MD5 {file_status}: {file_names}")
+            listed = ", ".join(file_names[:20])
+            if len(file_names) > 20:
+                listed = f"{listed}, and {len(file_names) - 20} more"
+            errors.append(f"{len(file_names)} {MD5_STATUS_MSG[file_status]} ({listed})")
+    if len(errors) == 0:
         exit_msg = "Valid MD5"
         return 0, exit_msg
     else:
-        exit_msg = results
+        exit_msg = "; ".join(errors)
         return 1, exit_msg
 
 
@@ -602,9 +904,32 @@ def update_folder_stats(folder_id, logger):
         return True
 
 
-def run_checks_folder_p(project_info, folder_path, logfile_folder, logger):
+def export_folder_metrics(folder_name, folder_id, logger):
     """
-    Process a folder in parallel
+    Log the time in each stage of the folder and save the metrics to
+    settings.metrics_folder (JSON) and settings.metrics_textfile (Prometheus)
+    """
+    summary = folder_metrics.summary()
+    for stage, values in summary['stages'].items():
+        logger.info(f"Stage {stage}: {values['runs']} runs, {values['wall']:.2f} s, "
+                    f"{values['cpu']:.2f} s CPU, {values['bytes'] / 1e6:.1f} MB read")
+    metrics_folder = getattr(settings, 'metrics_folder', None)
+    metrics_textfile = getattr(settings, 'metrics_textfile', None)
+    if metrics_folder is None and metrics_textfile is None:
+        return
+    json_path = None if metrics_folder is None else f"{metrics_folder}/{folder_name}_{folder_id}.json"
+    try:
+        folder_metrics.export(json_path, metrics_textfile, settings.project_alias)
+    except OSError as e:
+        logger.error(f"Could not save the metrics of folder {folder_id} ({e})")
+
+
+def run_checks_folder_p(project_info, folder_path, logfile_folder, logger, only_files=None):
+    """
+    Process a folder in parallel.
+    If only_files is a set of paths, the file checks only run on those files
+    (or their pairs), the folder checks run on all of them. It is checked
+    even if completed and settings.run_once is set.
     """
     project_id = project_info['project_alias']
     transcription = project_info['transcription']
@@ -659,17 +984,20 @@ def run_checks_folder_p(project_info, folder_path, logfile_folder, logger):
         logger.info(f"Folder ready for or delivered to for DAMS, skipping {folder_path}")
         return folder_id
     # Check if QC has been run
-    folder_info = send_request(f"{settings.api_url}/folders/{folder_id}", default_payload, logger, log_res = False)
+    folder_info = get_records(f"{settings.api_url}/folders/{folder_id}", default_payload, logger, 'files', FileInfo)
     if folder_info is False:
         return False
     if folder_info['qc_status'] != "QC Pending":
         # QC done, so skip
         logger.info(f"Folder QC has been completed, skipping {folder_path}")
         return folder_id
-    if folder_info['status'] == 0 and folder_info['file_errors'] == 0 and settings.run_once is True:
-        # Folder done, so skip
+    if folder_info['status'] == 0 and folder_info['file_errors'] == 0 and settings.run_once is True \
+            and only_files is None:
+        # Folder done, so skip. Files that changed in watch mode are checked
+        # (only_files), or a completed folder would not see new files
         logger.info(f"Folder has been completed, skipping {folder_path}")
         return folder_id
+    folder_metrics.start_folder(folder_id, folder_path)
     # Tag folder as under verification
     payload = {'type': 'folder',
                'folder_id': folder_id,
@@ -681,51 +1009,39 @@ def run_checks_folder_p(project_info, folder_path, logfile_folder, logger):
     if r is False:
         return False
     # Get all files in folder
-    files = []
-    for root, d_names, f_names in os.walk(folder_path):
-        for f in f_names:
-            files.append(os.path.join(root, f))
+    records = scan_folder(folder_path)
     # Extraneous files?
-    image_files = []
     image_main_files = []
     md5_allowed_files = []
     if 'raw_pair' in project_checks:
         allowed_files = [settings.md5_file, settings.main_files, settings.raw_files]
-        allowed_image_files = [settings.main_files, settings.raw_files]
         md5_files = [settings.main_files, settings.raw_files]
     else:
         allowed_files = [settings.md5_file, settings.main_files]
-        allowed_image_files = [settings.main_files]
         md5_files = [settings.main_files]
     if settings.data_files != None:
         allowed_files = [settings.md5_file, settings.main_files, settings.data_files]
         md5_files = [settings.main_files, settings.data_files]
-    for file in files:
-        if Path(file).suffix not in allowed_files:
-            file_suffix = Path(file).suffix
-            payload = {'type': 'folder', 'folder_id': folder_id, 'api_key': settings.api_key, 'property': 'status1', 'value': f'Extraneous files: {file} ({file_suffix} not in {allowed_files})'}
+    for record in records:
+        if record.suffix not in allowed_files:
+            payload = {'type': 'folder', 'folder_id': folder_id, 'api_key': settings.api_key, 'property': 'status1', 'value': f'Extraneous files: {record.path} ({record.suffix} not in {allowed_files})'}
             r = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger)
             if r is False:
                 return False
             return False
         else:
-            if Path(file).suffix in md5_files:
-                md5_allowed_files.append(file)
-            if Path(file).suffix in allowed_image_files:
-                image_files.append(file)
-            if Path(file).suffix == settings.main_files:
-                image_main_files.append(file)
+            if record.suffix in md5_files:
+                md5_allowed_files.append(record)
+            if record.suffix == settings.main_files:
+                image_main_files.append(record)
     # Check for deleted files
+    main_stems = Counter(record.stem for record in image_main_files)
     for file in folder_info['files']:
-        total = 0
-        for f in image_main_files:
-            f_name = Path(f).stem
-            if f_name == file['file_name']:
-                total += 1
+        total = main_stems[file.file_name]
         if total == 0:
             # File not found, delete from db
             payload = {'type': 'file',
-                    'file_id': file['file_id'],
+                    'file_id': file.file_id,
                     'api_key': settings.api_key,
                     'property': 'delete',
                     'value': True
@@ -734,13 +1050,13 @@ def run_checks_folder_p(project_info, folder_path, logfile_folder, logger):
             if r is False:
                 return False
         elif total > 1:
-            payload = {'type': 'folder', 'folder_id': folder_id, 'api_key': settings.api_key, 'property': 'status1', 'value': 'Dupe file in folder ({})'.format(f_name)}
+            payload = {'type': 'folder', 'folder_id': folder_id, 'api_key': settings.api_key, 'property': 'status1', 'value': 'Dupe file in folder ({})'.format(file.file_name)}
             r = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger)
             if r is False:
                 return False
     # Check if filenames have spaces
-    for file in files:
-        if " " in file:
+    for record in records:
+        if " " in record.path:
             payload = {'type': 'folder',
                'folder_id': folder_id,
                'api_key': settings.api_key,
@@ -756,10 +1072,7 @@ def run_checks_folder_p(project_info, folder_path, logfile_folder, logger):
             return False
     # MD5 required?
     if settings.md5_required:
-        md5_files = []
-        for f in files:
-            if Path(f).suffix == settings.md5_file:
-                md5_files.append(f)
+        md5_files = [record.path for record in records if record.suffix == settings.md5_file]
         # Check if MD5 exists in tif folder
         if len(md5_files) == 0:
             folder_status_msg = "MD5 files missing"
@@ -773,7 +1086,7 @@ def run_checks_folder_p(project_info, folder_path, logfile_folder, logger):
             return False
         else:
             # Check if the MD5 file matches the contents of the folder
-            md5_check, md5_error = validate_md5(md5_files, md5_allowed_files)
+            md5_check, md5_error = validate_md5(md5_files, md5_allowed_files, logger)
             if md5_check == 0:
                 property = 'tif_md5_matches_ok'
             else:
@@ -793,7 +1106,7 @@ def run_checks_folder_p(project_info, folder_path, logfile_folder, logger):
                 if r is False:
                     return False
     if 'raw_pair' in project_checks:
-        raw_files = [file for file in files if Path(file).suffix == settings.raw_files]
+        raw_files = [record for record in records if record.suffix == settings.raw_files]
         if len(image_main_files) != len(raw_files):
             folder_status_msg = f"No. of files do not match (main: {len(image_main_files)}, raws: {len(raw_files)})"
             payload = {'type': 'folder', 'folder_id': folder_id, 'api_key': settings.api_key, 'property': 'status1',
@@ -814,53 +1127,47 @@ def run_checks_folder_p(project_info, folder_path, logfile_folder, logger):
     ###############
     # Parallel
     ###############
-    no_tasks = len(image_main_files)
-    if settings.no_workers == 1:
-        print_str = "Started run of {notasks} tasks for {folder_path}"
-        print_str = print_str.format(notasks=str(locale.format_string("%d", no_tasks, grouping=True)), folder_path=folder_path)
-        logger.info(print_str)
-        # Process files in parallel
-        for file in image_main_files:
-            res = process_image_p(file, folder_id, raw_files, transcription, logfile_folder)
-            if res is False:
-                return False
+    ctx = FolderContext(folder_id, transcription, project_checks, folder_info['files'], raw_files)
+    # Insert the new files before the checks
+    if register_files(ctx, image_main_files, logger) is False:
+        return False
+    if only_files is None:
+        check_files = image_main_files
     else:
-        print_str = "Started parallel run of {notasks} tasks on {workers} workers for {folder_path}"
-        print_str = print_str.format(notasks=str(locale.format_string("%d", no_tasks, grouping=True)), workers=str(
-            settings.no_workers), folder_path=folder_path)
-        logger.info(print_str)
-        # Process files in parallel
-        inputs = zip(image_main_files, itertools.repeat(folder_id), itertools.repeat(raw_files), itertools.repeat(transcription), itertools.repeat(logfile_folder))
-        with Pool(settings.no_workers) as pool:
-            pool.starmap(process_image_p, inputs)
-            pool.close()
-            pool.join()
-    # Run end-of-folder checks
-    if 'sequence' in project_checks:
-        no_tasks = len(image_main_files)
-        project_files = send_request(f"{settings.api_url}/projects/{settings.project_alias}/files", default_payload, logger, log_res = False)
-        if project_files is False:
-            return False
-        if settings.no_workers == 1:
-            print_str = "Started run of {notasks} tasks for 'sequence'"
-            print_str = print_str.format(notasks=str(locale.format_string("%d", no_tasks, grouping=True)))
-            logger.info(print_str)
-            # Process files in parallel
-            for file in image_main_files:
-                sequence_validate(file, folder_id, project_files)
-        else:
-            print_str = "Started parallel run of {notasks} tasks on {workers} workers for 'sequence'"
-            print_str = print_str.format(notasks=str(locale.format_string("%d", no_tasks, grouping=True)), workers=str(settings.no_workers))
-            logger.info(print_str)
-            # Process files in parallel
-            inputs = zip(image_main_files, itertools.repeat(folder_id), itertools.repeat(project_files))
-            with Pool(settings.no_workers) as pool:
-                pool.starmap(sequence_validate, inputs)
-                pool.close()
-                pool.join()
+        changed_stems = {os.path.splitext(os.path.basename(file))[0] for file in only_files}
+        check_files = [record for record in image_main_files if record.stem in changed_stems]
+    # Resume from the files completed in a previous run
+    checkpoints = get_checkpoints()
+    if checkpoints is not None:
+        checkpoints = checkpoints.folder(folder_id)
+        resumed = [record for record in check_files if 'done' in checkpoints.steps(record)]
+        if len(resumed) > 0:
+            logger.info(f"Skipping {len(resumed)} files completed in a previous run of {folder_path}")
+            check_files = [record for record in check_files if 'done' not in checkpoints.steps(record)]
+    # Results are sent to the API in the background
+    submitter = ResultSubmitter(logger, folder_id=folder_id)
+    try:
+        res = run_checks_files(ctx, check_files, folder_path, logger, submitter, checkpoints)
+        # End-of-folder checks
+        if res is not False and 'sequence' in project_checks:
+            submit_sequences(ctx, image_main_files, logger, submitter)
+    finally:
+        # Wait for the results before the folder is updated
+        submit_failed = submitter.close()
+    if len(submit_failed) > 0:
+        logger.error(f"Could not send the results of {len(submit_failed)} files to the API: {submit_failed}")
+    if res is False:
+        return False
+    if len(submitter.saved) > 0:
+        # Completed once the outbox is sent and the folder checked again
+        logger.warning(f"Results of {len(submitter.saved)} files of {folder_path} are in the outbox, "
+                       f"the folder is not completed until they are sent")
+        return folder_id
     # Verify numbers match
     logger.info(f"Folder count verification {folder_id}")
-    folder_info = send_request(f"{settings.api_url}/folders/{folder_id}", default_payload, logger, log_res = False)
+    folder_info = get_records(f"{settings.api_url}/folders/{folder_id}", default_payload, logger, 'files', FileInfo)
+    if folder_info is False:
+        return False
     no_files_api = len(folder_info['files'])
     no_files_main = len(image_main_files)
     logger.info(f"Folder numbers match: (folder_id:{folder_id}) {no_files_main}/{no_files_api}")
@@ -884,376 +1191,961 @@ def run_checks_folder_p(project_info, folder_path, logfile_folder, logger):
         r = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger)
         if r is False:
             return False
+    # Checkpoints are only needed to resume a folder that was interrupted
+    if checkpoints is not None:
+        checkpoints.clear()
+    export_folder_metrics(folder_name, folder_id, logger)
     logger.info(f"Folder {folder_path} completed")
     return folder_id
 
 
-def process_image_p(filename, folder_id, raw_files, transcription, logfile_folder):
-    """
-    Run checks for image files
-    """
-    import settings
-    import random
-    import logging
-    import time
-    # import subprocess
-    import requests
-    random_int = random.randint(1, 1000)
-    # Logging
-    current_time = time.strftime("%Y%m%d_%H%M%S", time.localtime())
-    logfile = f"{logfile_folder}/{current_time}_{random_int}.log"
-    logging.basicConfig(filename=logfile, filemode='a', level=logging.DEBUG,
-                        format='%(levelname)s | %(asctime)s | %(filename)s:%(lineno)s | %(message)s',
-                        datefmt='%y-%b-%d %H:%M:%S')
-    logger = logging.getLogger(f"osprey_{random_int}")
-    main_file_path = filename
-    logger.info(f"filename: {main_file_path}")
-    filename_stem = Path(filename).stem
-    filename_suffix = Path(filename).suffix[1:]
-    file_name = Path(filename).name
-    osprey_wd = settings.tmp_folder
-    default_payload = {'api_key': settings.api_key}
-    # Get folder info
-    folder_info = send_request(f"{settings.api_url}/folders/{folder_id}", default_payload, logger, log_res = False)
-    if folder_info is False:
+
+
+class Checkpoints(object):
+    """
+    Steps of the checks completed for each file, saved in a SQLite file so
+    a folder that was interrupted resumes where it stopped. A step is saved
+    once its results were sent to the API (or saved in the outbox); the
+    previews as soon as they are created. The steps of a file are ignored
+    if its size or modification time changed.
+    """
+    def __init__(self, path):
+        # path as set in settings, and the absolute path, so the file does not
+        # depend on the working directory when it is opened
+        self.name = path
+        self.path = os.path.abspath(path)
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.con:
+            self.con.execute("CREATE TABLE IF NOT EXISTS checkpoints (folder_id TEXT, file_path TEXT, "
+                             "size INTEGER, mtime REAL, step TEXT, PRIMARY KEY (folder_id, file_path, step))")
+
+    def folder(self, folder_id):
+        """
+        Steps completed for the files of a folder
+        """
+        return FolderCheckpoints(self, folder_id)
+
+    def load(self, folder_id):
+        steps = {}
+        with self.lock:
+            rows = self.con.execute("SELECT file_path, size, mtime, step FROM checkpoints WHERE folder_id = ?",
+                                    (str(folder_id),)).fetchall()
+        for file_path, size, mtime, step in rows:
+            steps.setdefault((file_path, size, mtime), set()).add(step)
+        return steps
+
+    def mark(self, folder_id, record, steps):
+        with self.lock, self.con:
+            self.con.executemany("INSERT OR REPLACE INTO checkpoints (folder_id, file_path, size, mtime, step) "
+                                 "VALUES (?, ?, ?, ?, ?)",
+                                 [(str(folder_id), record.path, record.size, record.mtime, step) for step in steps])
+
+    def clear(self, folder_id):
+        with self.lock, self.con:
+            self.con.execute("DELETE FROM checkpoints WHERE folder_id = ?", (str(folder_id),))
+
+
+class FolderCheckpoints(object):
+    """
+    Checkpoints of the files of one folder
+    """
+    def __init__(self, checkpoints, folder_id):
+        self.checkpoints = checkpoints
+        self.folder_id = folder_id
+        self.saved = checkpoints.load(folder_id)
+
+    def steps(self, record):
+        """
+        Steps completed for a file, a set
+        """
+        return set(self.saved.get((record.path, record.size, record.mtime), set()))
+
+    def mark(self, record, steps):
+        self.checkpoints.mark(self.folder_id, record, steps)
+
+    def clear(self):
+        self.checkpoints.clear(self.folder_id)
+        self.saved = {}
+
+
+_checkpoints = None
+
+
+def get_checkpoints():
+    """
+    Get the checkpoints file set in settings, None if not used
+    """
+    global _checkpoints
+    path = getattr(settings, 'checkpoints', None)
+    if path is None:
+        return None
+    if _checkpoints is None or _checkpoints.name != path:
+        _checkpoints = Checkpoints(path)
+    return _checkpoints
+
+
+class Check(NamedTuple):
+    """
+    A check in the registry
+    """
+    name: str
+    # Function called with (inputs, results), returns (check_results, check_info)
+    # or None if the check does not apply to the file
+    func: Callable
+    # What the check reads: 'header', 'image', 'bytes' or 'tool'
+    inputs: tuple
+    # Relative cost, cheaper checks run first
+    cost: int
+    # Checks that have to finish before, if they are in the project
+    depends: tuple
+    # Stage of the pipeline where the check runs
+    stage: str
+
+
+# Stage of the pipeline that provides each input
+INPUT_STAGES = {'header': 'header', 'image': 'decode', 'bytes': 'hash', 'tool': 'tools'}
+STAGES = ['header', 'decode', 'hash', 'tools']
+
+# Registered checks, in the order the results are reported
+CHECKS = {}
+
+
+def register_check(name, inputs=(), cost=1, depends=()):
+    """
+    Decorator to add a check to the registry. The check runs in the stage of its
+    last input, or of its last dependency if it uses no input.
+    """
+    def decorator(func):
+        stages = [INPUT_STAGES[i] for i in inputs] + [CHECKS[d].stage for d in depends]
+        stage = max(stages, key=STAGES.index) if len(stages) > 0 else STAGES[0]
+        CHECKS[name] = Check(name, func, tuple(inputs), cost, tuple(depends), stage)
+        return func
+    return decorator
+
+
+class FileInputs(object):
+    """
+    Inputs of the checks of a file, shared by the checks that use them
+    """
+    def __init__(self, file_path, file_id=None, raw_file=None):
+        self.file_path = file_path
+        self.file_id = file_id
+        self.raw_file = raw_file
+        self._image = None
+
+    def header(self):
+        """
+        The file opened with Pillow, the pixels are not read until they are used
+        """
+        if self._image is None:
+            self._image = Image.open(self.file_path)
+        return self._image
+
+    def close(self):
+        if self._image is not None:
+            self._image.close()
+            self._image = None
+
+
+def run_checks(stage, inputs, project_checks, results, logger, skip=(), timings=None):
+    """
+    Run the checks of the project registered for a stage, cheapest first, once the
+    checks they depend on have finished. Checks with external programs run at the
+    same time in threads, the others one after the other since they share the
+    opened file. A check that raises is reported as failed, the rest still run.
+    results is the dict of (check_results, check_info) by check, updated in place.
+    The timing of each check is added to timings, a list, if given.
+    The checks in skip (completed in a previous run) run again if a check
+    that is not completed depends on their results.
+    """
+    skip = set(skip)
+    for check in CHECKS.values():
+        if check.name in project_checks and check.name not in skip and check.name not in results \
+                and STAGES.index(check.stage) >= STAGES.index(stage):
+            skip.difference_update(check.depends)
+    pending = sorted((check for check in CHECKS.values()
+                      if check.stage == stage and check.name in project_checks
+                      and check.name not in skip and check.name not in results),
+                     key=lambda check: check.cost)
+    finished = set(results) | set(skip)
+
+    def ready(check):
+        return all(d in finished or d not in project_checks for d in check.depends)
+
+    def run(check):
+        try:
+            with timed(f"check:{check.name}", inputs.file_path, timings):
+                return check.func(inputs, results)
+        except Exception as e:
+            return 1, f"{check.name} could not run on {inputs.file_path}: {e}"
+
+    def done(check, res):
+        finished.add(check.name)
+        if res is not None:
+            results[check.name] = res
+            logger.info("%s: %s %s", check.name, inputs.file_id, Truncated(res))
+
+    executor = None
+    running = {}
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            ready_checks = [check for check in pending if ready(check)]
+            for check in ready_checks:
+                pending.remove(check)
+                if 'tool' in check.inputs:
+                    if executor is None:
+                        executor = ThreadPoolExecutor(len(CHECKS))
+                    running[executor.submit(run, check)] = check
+                else:
+                    done(check, run(check))
+            if len(running) > 0:
+                finished_futures, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished_futures:
+                    done(running.pop(future), future.result())
+            elif len(ready_checks) == 0:
+                # Depends on checks that did not run
+                break
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        inputs.close()
+    return results
+
+
+@register_check('raw_pair', inputs=('tool',), cost=80)
+def check_raw_pair(inputs, results):
+    """
+    Validate the raw file paired with the file, a missing raw file
+    is reported when the files are registered
+    """
+    if inputs.raw_file is None:
+        return None
+    rawfile_suffix = inputs.raw_file.suffix[1:]
+    check_results = 0
+    check_info = f"Raw file {inputs.raw_file.name} found for {inputs.file_path} ({inputs.file_id})."
+    jhove_future = start_tool(jhove_validate, inputs.raw_file.path)
+    magick_future = start_tool(magick_validate, inputs.raw_file.path)
+    check_results1, check_info1 = jhove_future.result()
+    check_results2, check_info2 = magick_future.result()
+    if check_results1 == 1:
+        res1 = f"JHOVE could not validate: {check_info1}"
+        check_results1 = 1
+    else:
+        res1 = f"JHOVE validated the file: {check_info1}"
+        check_results1 = 0
+    if check_results2 == 1:
+        if rawfile_suffix == "eip":
+            check_results2 = 0
+            res2 = ""
+        else:
+            res2 = f"Imagemagick could not validate: {check_info2}"
+            check_results2 = 1
+    else:
+        res2 = f"Imagemagick validated the file: {check_info2}"
+        check_results2 = 0
+    if (check_results1 + check_results2) > 0:
+        check_results = 1
+    return check_results, f"{check_info}; {res1}; {res2}"
+
+
+@register_check('jhove', inputs=('tool',), cost=50)
+def check_jhove(inputs, results):
+    """
+    Validate the file with JHOVE following settings.jhove_policy: "all" files,
+    only the TIFF files that fail tiff_problems ("suspect"), or these plus a
+    sample of the rest ("sample", settings.jhove_sample of the files).
+    The policy is added to check_info.
+    """
+    policy = getattr(settings, 'jhove_policy', 'all')
+    if policy == 'all' or Path(inputs.file_path).suffix.lower() not in ('.tif', '.tiff'):
+        check_results, check_info = jhove_validate(inputs.file_path)
+        return check_results, f"{check_info}; JHOVE policy: {policy}"
+    problems = tiff_problems(inputs.file_path)
+    if len(problems) > 0:
+        check_results, check_info = jhove_validate(inputs.file_path)
+        return check_results, f"{check_info}; JHOVE policy: {policy}, suspect file ({'; '.join(problems)})"
+    # The same files are in the sample in every run
+    if policy == 'sample' and zlib.crc32(os.fsencode(inputs.file_path)) % 10000 < getattr(settings, 'jhove_sample', 0.1) * 10000:
+        check_results, check_info = jhove_validate(inputs.file_path)
+        return check_results, f"{check_info}; JHOVE policy: {policy}, file in the sample"
+    return 0, f"TIFF structure valid, JHOVE not run; JHOVE policy: {policy}"
+
+
+@register_check('filename', cost=0, depends=('raw_pair', 'jhove'))
+def check_filename(inputs, results):
+    """
+    Reports the result of the JHOVE check, or of the raw pair
+    """
+    for check in ('jhove', 'raw_pair'):
+        if check in results:
+            return results[check]
+    return None
+
+
+@register_check('tifpages', inputs=('header',), cost=1)
+def check_tifpages(inputs, results):
+    return tifpages(inputs.file_path, inputs.header())
+
+
+@register_check('magick', inputs=('tool',), cost=40)
+def check_magick(inputs, results):
+    return magick_validate(inputs.file_path)
+
+
+@register_check('tif_compression', inputs=('header',), cost=1)
+def check_tif_compression(inputs, results):
+    return tif_compression(inputs.file_path, inputs.header())
+
+
+class FolderContext(object):
+    """
+    Folder-level data shared by the checks of all the files in a folder
+    """
+    def __init__(self, folder_id, transcription, project_checks, folder_files, raw_files):
+        self.folder_id = folder_id
+        self.transcription = transcription
+        self.project_checks = project_checks
+        # Files already in the API (FileInfo), by file_name
+        self.folder_files = {file.file_name: file for file in folder_files}
+        # Raw files, by stem
+        self.raw_files = {}
+        for record in raw_files:
+            self.raw_files.setdefault(record.stem, []).append(record)
+
+
+class FileTask(object):
+    """
+    A file moving through the stages of the checks, with the results so far
+    """
+    def __init__(self, record, completed=None):
+        self.record = record
+        # Steps completed in a previous run
+        self.completed = set() if completed is None else completed
+        self.file_path = record.path
+        self.file_stem = record.stem
+        self.file_suffix = record.suffix[1:]
+        self.file_name = record.name
+        self.file_id = None
+        self.file_info = None
+        # FileRecord of the raw pair
+        self.raw_file = None
+        self.raw_missing = False
+        # Hashes of the file and of the raw pair, by algorithm
+        self.file_digests = None
+        self.raw_digests = None
+        self.exif = None
+        # Results of the checks, as (check_results, check_info)
+        self.checks = {}
+        self.failed = False
+
+
+class FileRecord(NamedTuple):
+    """
+    A file found when scanning a folder, with the values of its stat
+    """
+    path: str
+    name: str
+    stem: str
+    # Includes the dot, as in settings.main_files
+    suffix: str
+    size: int
+    mtime: float
+    inode: int
+
+
+def scan_folder(folder_path):
+    """
+    Get all the files under folder_path in a single pass with os.scandir,
+    stat is called once per file. Returns a list of FileRecord, sorted by path.
+    """
+    records = []
+    dirs = [folder_path]
+    while len(dirs) > 0:
+        with os.scandir(dirs.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.is_file():
+                    file_stat = entry.stat()
+                    stem, suffix = os.path.splitext(entry.name)
+                    records.append(FileRecord(entry.path, entry.name, stem, suffix,
+                                              file_stat.st_size, file_stat.st_mtime, file_stat.st_ino))
+    records.sort()
+    return records
+
+
+def new_file_values(record):
+    """
+    Values to insert a file in the API
+    """
+    return {
+        'filename': record.stem,
+        'timestamp': datetime.fromtimestamp(record.mtime).strftime('%Y-%m-%d %H:%M:%S'),
+        'filetype': record.suffix[1:].lower(),
+        'filesize': record.size
+        }
+
+
+def new_file(folder_id, record, logger):
+    """
+    Insert a file and its size in the API, returns the file_info or False
+    """
+    values = new_file_values(record)
+    payload = {
+            'api_key': settings.api_key,
+            'type': "file",
+            'folder_id': folder_id,
+            'filename': values['filename'],
+            'timestamp': values['timestamp'],
+            'filetype': values['filetype'],
+            }
+    r = send_request(f"{settings.api_url}/new/{settings.project_alias}", payload, logger)
+    if r is False:
         return False
-    # Get project info
-    project_info = send_request(f"{settings.api_url}/projects/{settings.project_alias}", default_payload, logger)
-    if project_info is False:
+    logger.debug("new_file:%s", r['result'])
+    file_info = r['result'][0]
+    payload = {
+        'api_key': settings.api_key,
+        'type': "filesize",
+        'file_id': file_info['file_id'],
+        'filetype': values['filetype'],
+        'filesize': values['filesize']
+    }
+    r = send_request(f"{settings.api_url}/new/{settings.project_alias}", payload, logger)
+    if r is False:
         return False
-    project_checks = project_info['project_checks']
-    logger.info(f"project_checks: {project_checks}")
-    # Check if file exists, insert if not
-    file_id = None
-    for file in folder_info['files']:
-        if file['file_name'] == filename_stem:
-            file_id = file['file_id']
-            file_info = file
-            break
-    if file_id is None:
-        # Get modified date for file
-        file_timestamp_float = os.path.getmtime(main_file_path)
-        file_timestamp = datetime.fromtimestamp(file_timestamp_float).strftime('%Y-%m-%d %H:%M:%S')
+    return file_info
+
+
+def register_files(ctx, files, logger):
+    """
+    Insert in the API the files that are not there yet, before running the checks.
+    If settings.bulk_new_files is True, all the files are sent in one request,
+    otherwise one file at a time from http_workers threads.
+    """
+    new_files = [record for record in files if record.stem not in ctx.folder_files]
+    if len(new_files) == 0:
+        return True
+    logger.info(f"Registering {len(new_files)} new files in folder {ctx.folder_id}")
+    if getattr(settings, 'bulk_new_files', False):
         payload = {
                 'api_key': settings.api_key,
-                'type': "file",
-                'folder_id': folder_id,
-                'filename': filename_stem,
-                'timestamp': file_timestamp,
-                'filetype': filename_suffix.lower(),
+                'type': "files",
+                'folder_id': ctx.folder_id,
+                'files': json.dumps([new_file_values(record) for record in new_files])
                 }
-        file_info = send_request(f"{settings.api_url}/new/{settings.project_alias}", payload, logger)
-        if file_info is False:
-            return False
-        else:
-            file_info = file_info['result']
-        logging.debug("new_file:{}".format(file_info))
-        file_id = file_info[0]['file_id']
-        logging.debug("file_size_pre: {}".format(main_file_path))
-        file_size = os.path.getsize(main_file_path)
-        logging.debug("file_size: {} {}".format(main_file_path, file_size))
-        filetype = filename_suffix
-        payload = {
-            'api_key': settings.api_key,
-            'type': "filesize",
-            'file_id': file_id,
-            'filetype': filetype.lower(),
-            'filesize': file_size
-        }
-        r = send_request(f"{settings.api_url}/new/{settings.project_alias}", payload, logger)
+        r = send_request(f"{settings.api_url}/new/{settings.project_alias}", payload, logger, log_res = False)
         if r is False:
             return False
-        # Refresh folder info
-        folder_info = send_request(f"{settings.api_url}/folders/{folder_id}", default_payload, logger, log_res = False)
-        if folder_info is False:
-            return False
-        for file in folder_info['files']:
-            if file['file_name'] == filename_stem:
-                file_id = file['file_id']
-                file_info = file
-                break
-    # File exists, tag if there is a dupe
-    if 'unique_file' in project_checks:
-        payload = {'type': 'file',
-                    'property': 'unique',
-                    'folder_id': folder_id,
-                    'file_id': file_id,
-                    'api_key': settings.api_key,
-                    'file_check': 'unique_file',
-                    'value': True,
-                    'check_info': True
-                    }
-        folder_info = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger)
-        if folder_info is False:
-            return False
-    # Check if there is a dupe in another project
-    if 'unique_other' in project_checks:
-        payload = {'type': 'file',
-                    'property': 'unique_other',
-                    'folder_id': folder_id,
-                    'file_id': file_id,
-                    'api_key': settings.api_key,
-                    'file_check': 'unique_other',
-                    'value': True,
-                    'check_info': True
-                    }
-        r = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger)
-        if r is False:
+        for file_info in r['result']:
+            ctx.folder_files[file_info['file_name']] = FileInfo(file_info['file_id'], file_info['file_name'])
+        return True
+    with ThreadPoolExecutor(getattr(settings, 'http_workers', 4)) as executor:
+        results = executor.map(lambda record: new_file(ctx.folder_id, record, logger), new_files)
+        for record, file_info in zip(new_files, results):
+            if file_info is False:
+                return False
+            ctx.folder_files[record.stem] = FileInfo(file_info['file_id'], record.stem)
+    return True
+
+
+def file_register(task, ctx, logger):
+    """
+    Get the file_id of a file, insert it in the API if it is new
+    """
+    file_info = ctx.folder_files.get(task.file_stem)
+    if file_info is None:
+        file_info = new_file(ctx.folder_id, task.record, logger)
+        if file_info is False:
             return False
-    logging.info(f"file_info: {file_id} - {file_info}")
-    # Generate jpg preview, if needed
-    jpg_prev = jpgpreview(file_id, folder_id, main_file_path, logger)
-    logger.info(f"jpg_prev: {file_id} {main_file_path} {jpg_prev}")
-    if jpg_prev is False:
-        return False
-    # Generate zoomable jpg preview
-    jpg_prev = jpgpreview_zoom(file_id, folder_id, main_file_path, logger)
-    if jpg_prev is False:
-        return False
-    logger.info(f"jpgpreview_zoom: {file_id} {main_file_path} {jpg_prev}")
-    file_md5 = get_filemd5(main_file_path, logger)
-    if file_md5 is False:
-        return False    
-    logger.info(f"file_md5: {file_id} {main_file_path} - {file_md5}")
-    payload = {'type': 'file',
-               'property': 'filemd5',
-               'file_id': file_id,
-               'api_key': settings.api_key,
-               'filetype': filename_suffix,
-               'value': file_md5
-               }
-    r = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger)
-    if r is False:
-        logger.error(r)
+        file_info = FileInfo(file_info['file_id'], task.file_stem)
+    task.file_id = file_info.file_id
+    task.file_info = file_info
+    logger.info("file_info: %s - %s", task.file_id, file_info)
+    if 'raw_pair' in ctx.project_checks:
+        paired_files = file_pair_check(task.file_name, ctx.raw_files)
+        if len(paired_files) == 0:
+            task.raw_missing = True
+            task.checks['raw_pair'] = (1, f"Raw file not found for {task.file_stem} ({task.file_id})")
+        elif len(paired_files) > 1:
+            task.checks['raw_pair'] = (1, f"{len(paired_files)} raw files found for {task.file_stem} ({task.file_id})")
+        else:
+            task.raw_file = paired_files[0]
+    return True
+
+
+def stage_order():
+    """
+    Stages of the checks of a file, in order. With settings.fail_fast the
+    checks run before the previews, which are skipped for the files that fail.
+    """
+    if getattr(settings, 'fail_fast', False):
+        return ['register', 'header', 'hash', 'tools', 'decode', 'submit']
+    return ['register', 'decode', 'hash', 'tools', 'submit']
+
+
+def file_header(task, ctx, logger):
+    """
+    Run the checks that only read the header of the file
+    """
+    run_checks('header', FileInputs(task.file_path, task.file_id), ctx.project_checks, task.checks, logger, task.completed)
+    return True
+
+
+def file_decode(file_id, folder_id, file_path, project_checks, completed=(), check_stages=('header', 'decode')):
+    """
+    Generate the previews and run the checks of check_stages, in a worker process.
+    Skips the steps in completed. Returns the result, the checks and the timings
+    of each step, which are added to the metrics of the folder by the parent.
+    """
+    logger = logging.getLogger("osprey")
+    checks = {}
+    timings = []
+    if 'previews' not in completed:
+        # Generate jpg preview, if needed
+        with timed('preview', file_path, timings):
+            jpg_prev = jpgpreview(file_id, folder_id, file_path, logger)
+        logger.info("jpg_prev: %s %s %s", file_id, file_path, jpg_prev)
+        if jpg_prev is False:
+            return False, checks, timings
+        # Generate zoomable jpg preview
+        with timed('preview_zoom', file_path, timings):
+            jpg_prev = jpgpreview_zoom(file_id, folder_id, file_path, logger)
+        logger.info("jpgpreview_zoom: %s %s %s", file_id, file_path, jpg_prev)
+        if jpg_prev is False:
+            return False, checks, timings
+    for stage in check_stages:
+        run_checks(stage, FileInputs(file_path, file_id), project_checks, checks, logger, completed, timings)
+    return True, checks, timings
+
+
+def file_hash(task, ctx, logger):
+    """
+    Get the hashes of the file and of its raw pair, in one read of each
+    """
+    try:
+        if 'filemd5' not in task.completed:
+            task.file_digests = file_digests(task.file_path)
+            logger.info("file_md5: %s %s - %s", task.file_id, task.file_path, task.file_digests)
+        if task.raw_file is not None and 'raw_pair' not in task.completed:
+            task.raw_digests = file_digests(task.raw_file.path)
+            logger.debug("raw_file_md5: %s %s (%s)", task.raw_file.stem, task.raw_digests, task.file_id)
+    except OSError as e:
+        logger.error(f"Could not hash {task.file_path} ({e})")
         return False
+    run_checks('hash', FileInputs(task.file_path, task.file_id, task.raw_file),
+               ctx.project_checks, task.checks, logger, task.completed)
+    return True
+
+
+def timed_exif(file_path):
+    with timed('exif', file_path):
+        return get_file_exif(file_path)
+
+
+def file_tools(task, ctx, logger):
+    """
+    Run the external programs on the file and its raw pair, all at the
+    same time up to the cap of settings.tool_processes
+    """
     # Get exif from TIF
-    data = get_file_exif(main_file_path)
+    exif_future = None
+    if 'exif' not in task.completed:
+        exif_future = start_tool(timed_exif, task.file_path)
+    run_checks('tools', FileInputs(task.file_path, task.file_id, task.raw_file),
+               ctx.project_checks, task.checks, logger, task.completed)
+    if exif_future is not None:
+        task.exif = exif_future.result()
+    return True
+
+
+def filemd5_payload(file_id, filetype, digests):
+    """
+    Payload with the MD5 of a file, the other hashes are sent in
+    the same request with the name of the algorithm as key
+    """
     payload = {'type': 'file',
-               'property': 'exif',
+               'property': 'filemd5',
                'file_id': file_id,
                'api_key': settings.api_key,
-               'filetype': filename_suffix.lower(),
-               'value': data
+               'filetype': filetype,
+               'value': digests['md5']
                }
-    r = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger, log_res = False)
-    if r is False:
-        logger.error(r)
-        return False
-    logger.info(f"Running checks on file {filename_stem} ({file_id}; folder_id: {folder_id})")
-    # Run each check
-    if 'raw_pair' in project_checks:
-        file_check = 'raw_pair'
-        # FilePair check and get MD5 hash
-        paired_files = file_pair_check(file_name, raw_files)
-        if len(paired_files) == 0:
-            check_results = 1
-            check_info = f"Raw file not found for {filename_stem} ({file_id})"
-            payload = {'type': 'file',
-                    'property': 'filemd5_missing_raw',
-                    'file_id': file_id,
-                    'api_key': settings.api_key,
-                    'filetype': "",
-                    'value': ""
-                    }
-            r = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger)
-            if r is False:
-                return False
-        elif len(paired_files) > 1:
-            check_results = 1
-            check_info = f"{len(paired_files)} raw files found for {filename_stem} ({file_id})"
-        else:
-            check_results = 0
-            check_info = f"Raw file {Path(paired_files[0]).name} found for {filename} ({file_id})."
-            # Copy raw to tmp
-            raw_file = paired_files[0]
-            # tmp_folder_rawfile = f"{osprey_wd}/{Path(raw_file).name}"
-            # try:
-            #     shutil.copy(raw_file, tmp_folder_rawfile)
-            # except shutil.Error as e:
-            #     logger.error(f"Error copying {raw_file} to {tmp_folder_rawfile}")
-            #     # shutil.rmtree(osprey_wd, ignore_errors=True)
-            #     return False
-            rawfile_suffix = Path(raw_file).suffix[1:]
-            check_results1, check_info1 = jhove_validate(raw_file)
-            check_results2, check_info2 = magick_validate(raw_file)
-            res = ""
-            if check_results1 == 1:
-                res1 = f"JHOVE could not validate: {check_info1}"
-                check_results1 = 1
-            else:
-                res1 = f"JHOVE validated the file: {check_info1}"
-                check_results1 = 0
-            if check_results2 == 1:
-                if rawfile_suffix == "eip":
-                    check_results2 = 0
-                    res2 = ""
-                else:
-                    res2 = f"Imagemagick could not validate: {check_info2}"
-                    check_results2 = 1
-            else:
-                res2 = f"Imagemagick validated the file: {check_info2}"
-                check_results2 = 0
-            if (check_results1 + check_results2) > 0:
-                check_results = 1
-            # MD5 of RAW file
-            file_md5 = get_filemd5(raw_file, logger)
-            if file_md5 is False:
-                return False
-            raw_filetype = Path(raw_file).suffix[1:]
-            logging.debug("raw_file_md5: {} {} ({})".format(Path(raw_file).stem, file_md5, file_id))
-            payload = {'type': 'file',
-                    'property': 'filemd5',
-                    'file_id': file_id,
-                    'api_key': settings.api_key,
-                    'filetype': raw_filetype.lower(),
-                    'value': file_md5
-                    }
-            r = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger)
-            if r is False:
-                return False
-            # Raw file size
-            file_size = os.path.getsize(raw_file)
-            logging.debug(f"raw_file_size: {Path(raw_file).stem} {file_size} ({file_id})")
-            raw_filetype = Path(raw_file).suffix[1:]
-            payload = {
-                'api_key': settings.api_key,
-                'type': "filesize",
-                'file_id': file_id,
-                'filetype': raw_filetype.lower(),
-                'filesize': file_size
-            }
-            r = send_request(f"{settings.api_url}/new/{settings.project_alias}", payload, logger)
-            if r is False:
-                return False
-            check_info = f"{check_info}; {res1}; {res2}"
-        payload = {'type': 'file',
-                    'property': 'filechecks',
-                    'folder_id': folder_id,
-                    'file_id': file_id,
-                    'api_key': settings.api_key,
-                    'file_check': file_check,
-                    'value': check_results,
-                    'check_info': f"{check_info}".replace(settings.project_datastorage, "")
-                    }
-        r = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger)
-        if r is False:
-            return False
-    if 'jhove' in project_checks:
-        file_check = 'jhove'
-        check_results, check_info = jhove_validate(main_file_path)
-        payload = {'type': 'file',
-                   'property': 'filechecks',
-                   'folder_id': folder_id,
-                   'file_id': file_id,
-                   'api_key': settings.api_key,
-                   'file_check': file_check,
-                   'value': check_results,
-                   'check_info': check_info.replace(settings.project_datastorage, "")
-                   }
-        r = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger)
-        if r is False:
-            return False
-    # if 'bits' in project_checks:
-    #     file_check = 'bits'
-    #     check_results, check_info = check_img_bits(main_file_path)
-    #     payload = {'type': 'file',
-    #                'property': 'filechecks',
-    #                'folder_id': folder_id,
-    #                'file_id': file_id,
-    #                'api_key': settings.api_key,
-    #                'file_check': file_check,
-    #                'value': check_results,
-    #                'check_info': check_info.replace(settings.project_datastorage, "")
-    #                }
-    #     r = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger)
-    #     if r is False:
-    #         shutil.rmtree(tmp_folder)
-    #         return False
-    if 'filename' in project_checks:
-        file_check = 'filename'
-        payload = {'type': 'file',
-                   'property': 'filechecks',
-                   'folder_id': folder_id,
-                   'file_id': file_id,
-                   'api_key': settings.api_key,
-                   'file_check': file_check,
-                   'value': check_results,
-                   'check_info': check_info.replace(settings.project_datastorage, "")
-                   }
-        r = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger)
-        if r is False:
-            return False
-    if 'tifpages' in project_checks:
-        file_check = 'tifpages'
-        logger.info("tifpages_pre: {} {}".format(file_id, main_file_path))
-        check_results, check_info = tifpages(main_file_path)
-        logger.info("tifpages: {} {} {}".format(file_id, check_results, check_info))
-        payload = {'type': 'file',
-                   'property': 'filechecks',
-                   'folder_id': folder_id,
-                   'file_id': file_id,
-                   'api_key': settings.api_key,
-                   'file_check': file_check,
-                   'value': check_results,
-                   'check_info': check_info
-                   }
-        r = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger)
-        if r is False:
-            return False
-    if 'magick' in project_checks:
-        file_check = 'magick'
-        check_results, check_info = magick_validate(main_file_path)
-        if check_results != 0:
+    for algorithm, digest in digests.items():
+        if algorithm != 'md5':
+            payload[algorithm] = digest
+    return payload
+
+
+def file_payloads(task, ctx, logger):
+    """
+    Build the requests with the results of a file, in the order the checks are reported.
+    Returns a list of (step, endpoint, payload, log_res), without the steps
+    completed in a previous run.
+    """
+    payloads = []
+    if task.file_id is None:
+        return payloads
+
+    def add(step, endpoint, payload, log_res=True):
+        if step not in task.completed:
+            payloads.append((step, endpoint, payload, log_res))
+
+    def filecheck(file_check, check_results, check_info):
+        add(file_check, 'update', {'type': 'file',
+                                   'property': 'filechecks',
+                                   'folder_id': ctx.folder_id,
+                                   'file_id': task.file_id,
+                                   'api_key': settings.api_key,
+                                   'file_check': file_check,
+                                   'value': check_results,
+                                   'check_info': check_info
+                                   })
+
+    # File exists, tag if there is a dupe
+    if 'unique_file' in ctx.project_checks:
+        add('unique_file', 'update', {'type': 'file',
+                                      'property': 'unique',
+                                      'folder_id': ctx.folder_id,
+                                      'file_id': task.file_id,
+                                      'api_key': settings.api_key,
+                                      'file_check': 'unique_file',
+                                      'value': True,
+                                      'check_info': True
+                                      })
+    # Check if there is a dupe in another project
+    if 'unique_other' in ctx.project_checks:
+        add('unique_other', 'update', {'type': 'file',
+                                       'property': 'unique_other',
+                                       'folder_id': ctx.folder_id,
+                                       'file_id': task.file_id,
+                                       'api_key': settings.api_key,
+                                       'file_check': 'unique_other',
+                                       'value': True,
+                                       'check_info': True
+                                       })
+    if task.file_digests is not None:
+        add('filemd5', 'update', filemd5_payload(task.file_id, task.file_suffix, task.file_digests))
+    if task.exif is not None:
+        add('exif', 'update', {'type': 'file',
+                               'property': 'exif',
+                               'file_id': task.file_id,
+                               'api_key': settings.api_key,
+                               'filetype': task.file_suffix.lower(),
+                               'value': task.exif
+                               }, False)
+    if task.failed:
+        return payloads
+    if task.raw_missing:
+        add('raw_pair', 'update', {'type': 'file',
+                                   'property': 'filemd5_missing_raw',
+                                   'file_id': task.file_id,
+                                   'api_key': settings.api_key,
+                                   'filetype': "",
+                                   'value': ""
+                                   })
+    if task.raw_digests is not None:
+        raw_filetype = task.raw_file.suffix[1:]
+        add('raw_pair', 'update', filemd5_payload(task.file_id, raw_filetype.lower(), task.raw_digests))
+        add('raw_pair', 'new', {'api_key': settings.api_key,
+                                'type': "filesize",
+                                'file_id': task.file_id,
+                                'filetype': raw_filetype.lower(),
+                                'filesize': task.raw_file.size
+                                })
+    # Results of the checks, in the order of the registry
+    for name in CHECKS:
+        if name not in task.checks:
+            continue
+        check_results, check_info = task.checks[name]
+        if name == 'magick' and check_results != 0:
             logger.error("magick error: {}".format(check_info))
-            return False
-        payload = {'type': 'file',
-                   'property': 'filechecks',
-                   'folder_id': folder_id,
-                   'file_id': file_id,
-                   'api_key': settings.api_key,
-                   'file_check': file_check,
-                   'value': check_results,
-                   'check_info': check_info.replace(settings.project_datastorage, "")
-                   }
-        r = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger)
+            task.failed = True
+            continue
+        if isinstance(check_info, str):
+            check_info = check_info.replace(settings.project_datastorage, "")
+        filecheck(name, check_results, check_info)
+    return payloads
+
+
+def file_submit(task, ctx, logger, submitter=None, checkpoints=None):
+    """
+    Send the results of a file to the API, in the background if there is a submitter.
+    The steps sent are saved in checkpoints, with 'done' if the file has no errors.
+    """
+    payloads = file_payloads(task, ctx, logger)
+    job = [(f"{settings.api_url}/{endpoint}/{settings.project_alias}", payload, log_res)
+           for step, endpoint, payload, log_res in payloads]
+    steps = {step for step, endpoint, payload, log_res in payloads}
+    if task.failed is False:
+        steps.add('done')
+
+    def on_done(sent):
+        if sent and checkpoints is not None:
+            checkpoints.mark(task.record, steps)
+
+    if submitter is not None:
+        submitter.submit(task.file_path, job, on_done)
+        return task.failed is False
+    for url, payload, log_res in job:
+        r = send_request(url, payload, logger, log_res = log_res)
         if r is False:
             return False
-    if 'tif_compression' in project_checks:
-        file_check = 'tif_compression'
-        check_results, check_info = tif_compression(main_file_path)
-        logger.info(f"tif_compression: {file_id} {check_results} {check_info}")
-        payload = {'type': 'file',
-                   'property': 'filechecks',
-                   'folder_id': folder_id,
-                   'file_id': file_id,
-                   'api_key': settings.api_key,
-                   'file_check': file_check,
-                   'value': check_results,
-                   'check_info': check_info
-                   }
-        r = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger)
-        if r is False:
+    on_done(True)
+    return task.failed is False
+
+
+def run_checks_files(ctx, image_main_files, folder_path, logger, submitter=None, checkpoints=None):
+    """
+    Run the checks of the files of a folder
+    """
+    no_tasks = len(image_main_files)
+    if settings.no_workers == 1:
+        print_str = "Started run of {notasks} tasks for {folder_path}"
+        print_str = print_str.format(notasks=str(locale.format_string("%d", no_tasks, grouping=True)), folder_path=folder_path)
+        logger.info(print_str)
+        # Process files one by one
+        for record in image_main_files:
+            res = process_image_p(record, ctx, logger, submitter, checkpoints)
+            if res is False:
+                return False
+    else:
+        print_str = "Started parallel run of {notasks} tasks on {workers} workers for {folder_path}"
+        print_str = print_str.format(notasks=str(locale.format_string("%d", no_tasks, grouping=True)), workers=str(
+            settings.no_workers), folder_path=folder_path)
+        logger.info(print_str)
+        # Process files in parallel, by stages
+        pipeline = FilePipeline(ctx, logger, submitter, checkpoints)
+        results = pipeline.run(image_main_files)
+        failed = [task.file_path for task in results if task.failed]
+        if len(failed) > 0:
+            logger.error(f"{len(failed)} files failed in {folder_path}: {failed}")
+    return True
+
+
+def decode_check_stages():
+    """
+    Stages of the checks that file_decode runs, with settings.fail_fast
+    the header checks run before in their own stage
+    """
+    if getattr(settings, 'fail_fast', False):
+        return ('decode',)
+    return ('header', 'decode')
+
+
+def pool_context():
+    """
+    Context to start the worker processes with settings.pool_start_method.
+    With "forkserver" each worker is forked from a server that imported the
+    modules in settings.pool_preload once, instead of from the main process
+    with its threads, or importing them again as with "spawn".
+    """
+    method = getattr(settings, 'pool_start_method', 'forkserver')
+    context = multiprocessing.get_context(method)
+    if method == 'forkserver':
+        context.set_forkserver_preload(getattr(settings, 'pool_preload', ['functions']))
+        # The server gets the environment but not sys.path, without the folders of
+        # this file and of settings it can not preload them and each worker imports
+        # them again. Started here so PYTHONPATH is only changed while it starts,
+        # the programs run later get the one of this process.
+        pythonpath = os.environ.get('PYTHONPATH')
+        folders = [os.path.dirname(os.path.abspath(file)) for file in (__file__, settings.__file__)]
+        paths = [] if pythonpath is None else pythonpath.split(os.pathsep)
+        os.environ['PYTHONPATH'] = os.pathsep.join(dict.fromkeys([p for p in paths if p != ""] + folders))
+        try:
+            multiprocessing.forkserver.ensure_running()
+        finally:
+            if pythonpath is None:
+                del os.environ['PYTHONPATH']
+            else:
+                os.environ['PYTHONPATH'] = pythonpath
+    return context
+
+
+def settings_values():
+    """
+    Values in settings that can be sent to the worker processes, so the changes
+    made at run time apply to them when they are not forked from this process
+    """
+    return {name: value for name, value in vars(settings).items()
+            if not name.startswith('_') and isinstance(value, (str, int, float, bool, list, tuple, dict, type(None)))}
+
+
+# Values of the folder in a worker process of the pool, set by decode_worker_init
+_decode_folder = None
+
+
+def decode_worker_init(folder_id, project_checks, check_stages, log_queue=None, values=None):
+    """
+    Initializer of the worker processes of a folder. The values shared by all
+    the files are sent once to each process, the tasks only send the file.
+    The records are logged to log_queue, written by the main process, and
+    values (from settings_values) replace the ones in settings.
+    """
+    global _decode_folder
+    worker_logging_init(log_queue)
+    if values is not None:
+        vars(settings).update(values)
+    _decode_folder = (folder_id, project_checks, check_stages)
+
+
+def decode_file(file_id, file_path, completed=()):
+    """
+    Run file_decode in a worker process, with the values of the folder set by decode_worker_init
+    """
+    folder_id, project_checks, check_stages = _decode_folder
+    return file_decode(file_id, folder_id, file_path, project_checks, completed, check_stages)
+
+
+def file_decode_task(task, ctx, logger, checkpoints=None, pool=None):
+    """
+    Run file_decode for a task, in pool if given (started with decode_worker_init),
+    and save the previews in checkpoints.
+    With settings.fail_fast the header checks have already run and the
+    previews of the files that failed a check are skipped.
+    """
+    if getattr(settings, 'fail_fast', False):
+        failed = [name for name, (check_results, check_info) in task.checks.items() if check_results != 0]
+        if len(failed) > 0:
+            logger.info(f"Skipping the previews of {task.file_path}, failed checks: {failed}")
+            return True
+    if pool is None:
+        res, checks, timings = file_decode(task.file_id, ctx.folder_id, task.file_path, ctx.project_checks,
+                                           task.completed, decode_check_stages())
+    else:
+        res, checks, timings = pool.apply_async(decode_file, (task.file_id, task.file_path, task.completed)).get()
+    task.checks.update(checks)
+    folder_metrics.add(timings)
+    if res is not False and checkpoints is not None and 'previews' not in task.completed:
+        checkpoints.mark(task.record, ['previews'])
+    return res
+
+
+def process_image_p(record, ctx, logger, submitter=None, checkpoints=None):
+    """
+    Run checks for image files, one stage after the other
+    """
+    task = FileTask(record, None if checkpoints is None else checkpoints.steps(record))
+    logger.info("filename: %s", task.file_path)
+    with timed('register', task.file_path):
+        if file_register(task, ctx, logger) is False:
             return False
-    # if 'tesseract' in project_checks:
-    #     file_check = 'tesseract'
-    #     heck_results = 0
-    #     check_info = "Not checked"
-    #     for patterns in settings.tesseract_pattern:
-    #         if patterns in Path(main_file_path).stem:
-    #             check_results, check_info = tesseract(main_file_path)
-    #             break
-    #     logger.info(f"tesseract: {file_id} {check_results} {check_info}")
-    #     payload = {'type': 'file',
-    #                'property': 'filechecks',
-    #                'folder_id': folder_id,
-    #                'file_id': file_id,
-    #                'api_key': settings.api_key,
-    #                'file_check': file_check,
-    #                'value': check_results,
-    #                'check_info': check_info
-    #                }
-    #     r = send_request(f"{settings.api_url}/update/{settings.project_alias}", payload, logger)
-    #     if r is False:
-    #         return False
-    return folder_id
+    logger.info("Running checks on file %s (%s; folder_id: %s)", task.file_stem, task.file_id, ctx.folder_id)
+    stages = {'header': lambda: file_header(task, ctx, logger),
+              'decode': lambda: file_decode_task(task, ctx, logger, checkpoints),
+              'hash': lambda: file_hash(task, ctx, logger),
+              'tools': lambda: file_tools(task, ctx, logger)}
+    for stage in stage_order()[1:-1]:
+        with timed(stage, task.file_path):
+            res = stages[stage]()
+        if res is False:
+            task.failed = True
+            break
+    with timed('submit', task.file_path):
+        if file_submit(task, ctx, logger, submitter, checkpoints) is False:
+            return False
+    return ctx.folder_id
+
+
+class FilePipeline(object):
+    """
+    Run the files of a folder through stages connected by bounded queues.
+    API calls and hashing run in threads, previews and the checks with Pillow
+    in a process pool, and the external programs in a limited number of slots,
+    so each resource is kept busy on its own.
+    """
+    def __init__(self, ctx, logger, submitter=None, checkpoints=None):
+        self.ctx = ctx
+        self.logger = logger
+        self.submitter = submitter
+        self.checkpoints = checkpoints
+        self.queue_size = getattr(settings, 'queue_size', 8)
+        http_workers = getattr(settings, 'http_workers', 4)
+        hash_workers = getattr(settings, 'hash_workers', 4)
+        tool_workers = getattr(settings, 'tool_workers', settings.no_workers)
+        # function, no. of threads, run even if the file failed before
+        stages = {
+            'register': (self.register, http_workers, False),
+            'header': (self.header, hash_workers, False),
+            'decode': (self.decode, settings.no_workers, False),
+            'hash': (self.hash, hash_workers, False),
+            'tools': (self.tools, tool_workers, False),
+            'submit': (self.submit, http_workers, True),
+        }
+        self.stages = [(name,) + stages[name] for name in stage_order()]
+        self.pool = None
+
+    def register(self, task):
+        return file_register(task, self.ctx, self.logger)
+
+    def header(self, task):
+        return file_header(task, self.ctx, self.logger)
 
+    def decode(self, task):
+        return file_decode_task(task, self.ctx, self.logger, self.checkpoints, self.pool)
+
+    def hash(self, task):
+        return file_hash(task, self.ctx, self.logger)
+
+    def tools(self, task):
+        return file_tools(task, self.ctx, self.logger)
+
+    def submit(self, task):
+        return file_submit(task, self.ctx, self.logger, self.submitter, self.checkpoints)
+
+    def _worker(self, name, func, run_failed, in_queue, out_queue):
+        while True:
+            task = in_queue.get()
+            if task is None:
+                break
+            if task.failed is False or run_failed:
+                try:
+                    with timed(name, task.file_path):
+                        res = func(task)
+                    if res is False:
+                        task.failed = True
+                except Exception as e:
+                    self.logger.error(f"Stage {name} failed for {task.file_path} ({e})")
+                    task.failed = True
+            out_queue.put(task)
+
+    def run(self, files):
+        """
+        Process the files (list of FileRecord), returns the list of FileTask
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        done = queue.Queue()
+        # Start the worker processes before the threads of the stages. The threads of
+        # the submitter and of the log are already running, with "fork" the workers
+        # are forked from a process with threads (the forkserver avoids it)
+        self.pool = pool_context().Pool(settings.no_workers, initializer=decode_worker_init,
+                                        initargs=(self.ctx.folder_id, self.ctx.project_checks, decode_check_stages(),
+                                                  get_log_queue(), settings_values()))
+        threads = []
+        for i, (name, func, no_threads, run_failed) in enumerate(self.stages):
+            out_queue = queues[i + 1] if i + 1 < len(self.stages) else done
+            stage_threads = [threading.Thread(target=self._worker, name=f"{name}_{j}",
+                                              args=(name, func, run_failed, queues[i], out_queue), daemon=True)
+                             for j in range(no_threads)]
+            for t in stage_threads:
+                t.start()
+            threads.append(stage_threads)
+        try:
+            for record in files:
+                # Blocks while the first stage is full
+                completed = None if self.checkpoints is None else self.checkpoints.steps(record)
+                queues[0].put(FileTask(record, completed))
+            # Close each stage once the ones before it are done
+            for i, stage_threads in enumerate(threads):
+                for _ in stage_threads:
+                    queues[i].put(None)
+                for t in stage_threads:
+                    t.join()
+        finally:
+            self.pool.close()
+            self.pool.join()
+        results = []
+        while not done.empty():
+            results.append(done.get())
+        return results
@@ -0,0 +1,155 @@
+# Timing of the stages of the checks for osprey_worker.py: wall time, CPU
+# time and bytes read, by stage and by file, exported at the end of each
+# folder as JSON and as a Prometheus textfile
+import os
+import json
+import time
+import threading
+
+
+def read_bytes():
+    """
+    Bytes read by the current thread so far (rchar in /proc/thread-self/io),
+    None where it is not available
+    """
+    try:
+        with open('/proc/thread-self/io', 'rb') as f:
+            for line in f:
+                if line.startswith(b'rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class timed(object):
+    """
+    Context manager that records the wall time, the CPU time of the thread and the
+    bytes read by the thread in stage for file_path. The record is added to the list
+    into (to send it from a worker process) or to the metrics of the folder.
+    """
+    def __init__(self, stage, file_path=None, into=None):
+        self.stage = stage
+        self.file_path = file_path
+        self.into = into
+
+    def __enter__(self):
+        self.read = read_bytes()
+        self.cpu = time.thread_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        read = read_bytes()
+        read = read - self.read if read is not None and self.read is not None else 0
+        record = (self.stage, self.file_path, wall, cpu, read)
+        if self.into is not None:
+            self.into.append(record)
+        else:
+            folder_metrics.add([record])
+        return False
+
+
+class Metrics(object):
+    """
+    Records of a folder, added from all the threads, and the totals of all
+    the folders checked by this process
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Totals by stage: [runs, wall, cpu, bytes]
+        self.totals = {}
+        self.start_folder(None, None)
+
+    def start_folder(self, folder_id, folder_path):
+        with self.lock:
+            self.folder_id = folder_id
+            self.folder_path = folder_path
+            self.started = time.perf_counter()
+            self.stages = {}
+            self.files = {}
+
+    def add(self, records):
+        """
+        Add records (stage, file_path, wall, cpu, bytes), from this process or a worker
+        """
+        with self.lock:
+            for stage, file_path, wall, cpu, read in records:
+                values = self.stages.setdefault(stage, {'runs': 0, 'wall': 0.0, 'wall_max': 0.0, 'cpu': 0.0, 'bytes': 0})
+                values['runs'] += 1
+                values['wall'] += wall
+                values['wall_max'] = max(values['wall_max'], wall)
+                values['cpu'] += cpu
+                values['bytes'] += read
+                totals = self.totals.setdefault(stage, [0, 0.0, 0.0, 0])
+                totals[0] += 1
+                totals[1] += wall
+                totals[2] += cpu
+                totals[3] += read
+                if file_path is not None:
+                    file_values = self.files.setdefault(file_path, {}).setdefault(stage, [0.0, 0.0, 0])
+                    file_values[0] += wall
+                    file_values[1] += cpu
+                    file_values[2] += read
+
+    def summary(self):
+        """
+        The metrics of the folder, as a dict for JSON
+        """
+        with self.lock:
+            return {
+                'folder_id': self.folder_id,
+                'folder_path': self.folder_path,
+                'seconds': time.perf_counter() - self.started,
+                'files': len(self.files),
+                'stages': {stage: dict(values) for stage, values in sorted(self.stages.items())},
+                'by_file': {file_path: {stage: {'wall': wall, 'cpu': cpu, 'bytes': read}
+                                        for stage, (wall, cpu, read) in stages.items()}
+                            for file_path, stages in self.files.items()},
+            }
+
+    def prometheus(self, project_alias):
+        """
+        The totals of this process and the last folder, in the Prometheus text format
+        """
+        labels = f'project="{project_alias}"'
+        lines = []
+        with self.lock:
+            for index, (name, description) in enumerate((
+                    ('osprey_stage_runs_total', "Times each stage ran"),
+                    ('osprey_stage_seconds_total', "Wall time in each stage"),
+                    ('osprey_stage_cpu_seconds_total', "CPU time in each stage, without external programs"),
+                    ('osprey_stage_read_bytes_total', "Bytes read in each stage"))):
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} counter")
+                for stage, totals in sorted(self.totals.items()):
+                    lines.append(f'{name}{{{labels},stage="{stage}"}} {totals[index]}')
+            lines.append("# HELP osprey_folder_seconds Wall time of the last folder")
+            lines.append("# TYPE osprey_folder_seconds gauge")
+            lines.append(f'osprey_folder_seconds{{{labels},folder_id="{self.folder_id}"}} {time.perf_counter() - self.started}')
+            lines.append("# HELP osprey_folder_files Files with metrics in the last folder")
+            lines.append("# TYPE osprey_folder_files gauge")
+            lines.append(f'osprey_folder_files{{{labels},folder_id="{self.folder_id}"}} {len(self.files)}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, json_path=None, textfile_path=None, project_alias=""):
+        """
+        Write the summary of the folder to json_path and the Prometheus
+        textfile to textfile_path, each through a temp file and a rename
+        so readers never see a partial file
+        """
+        for path, content in ((json_path, lambda: json.dumps(self.summary(), indent=1)),
+                              (textfile_path, lambda: self.prometheus(project_alias))):
+            if path is None:
+                continue
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(content())
+            os.replace(tmp_path, path)
+
+
+# Metrics of the folder being checked
+folder_metrics = Metrics()
@@ -11,8 +11,6 @@
 import logging
 import os
 import time
-import requests
-import numpy as np
 import json
 import locale
 import sys
@@ -23,6 +21,8 @@ import settings
 
 # Import helper functions
 from functions import *
+from watcher import FolderWatch
+from worker_logging import setup_logging, stop_logging
 
 ver = "2.11.0"
 
@@ -45,21 +45,28 @@ else:
 # Logging
 ############################################
 log_folder = "logs"
+logger = logging.getLogger("osprey")
 
-if not os.path.exists(log_folder):
-    os.makedirs(log_folder)
 
-# Logging
-current_time = time.strftime("%Y%m%d_%H%M%S", time.localtime())
-if worker_set != None:
-    logfile = f"{log_folder}/{settings.project_alias}_w{worker_set}_{current_time}.log"
-else:
-    logfile = f"{log_folder}/{settings.project_alias}_{current_time}.log"
-logging.basicConfig(filename=logfile, filemode='a', level=logging.DEBUG,
-                    format='%(levelname)s | %(asctime)s | %(filename)s:%(lineno)s | %(message)s',
-                    datefmt='%Y-%b-%d %H:%M:%S')
-logger = logging.getLogger("osprey")
-logging.info(f"osprey version {ver}")
+def start_logging():
+    """
+    Log to a new file in log_folder, returns its path. Runs from the main
+    block, not when the worker processes import this file.
+    """
+    if not os.path.exists(log_folder):
+        os.makedirs(log_folder)
+    current_time = time.strftime("%Y%m%d_%H%M%S", time.localtime())
+    if worker_set != None:
+        logfile = f"{log_folder}/{settings.project_alias}_w{worker_set}_{current_time}.log"
+    else:
+        logfile = f"{log_folder}/{settings.project_alias}_{current_time}.log"
+    # Written by a thread, for this process and the worker processes
+    setup_logging(logfile, level=logging.DEBUG,
+                  fmt='%(levelname)s | %(asctime)s | %(filename)s:%(lineno)s | %(message)s',
+                  datefmt='%Y-%b-%d %H:%M:%S')
+    logging.info(f"osprey version {ver}")
+    return logfile
+
 
 # Set locale for number format
 locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
@@ -68,19 +75,19 @@ locale.setlocale(locale.LC_ALL, 'en_US.UTF-8')
 ############################################
 # Check requirements
 ############################################
-if check_requirements(settings.jhove) is False:
-    logger.error("JHOVE was not found")
-    sys.exit(1)
-
-
-if check_requirements(settings.exiftool) is False:
-    logger.error("exiftool was not found")
-    sys.exit(1)
-
-
-if check_requirements(settings.magick) is False:
-    logger.error("imagemagick was not found")
-    sys.exit(1)
+def check_programs():
+    """
+    Exit if a program needed for the checks is not installed
+    """
+    if check_requirements(settings.jhove) is False:
+        logger.error("JHOVE was not found")
+        sys.exit(1)
+    if check_requirements(settings.exiftool) is False:
+        logger.error("exiftool was not found")
+        sys.exit(1)
+    if check_requirements(settings.magick) is False:
+        logger.error("imagemagick was not found")
+        sys.exit(1)
 
 
 ############################################
@@ -90,6 +97,8 @@ def main():
     """
     Main function to validate images in digitization projects.
     """
+    # Only needed here, the worker processes import this file
+    import requests
     if not os.path.isdir(settings.project_datastorage):
         logger.error(f"Path not found: {settings.project_datastorage}")
         sys.exit(1)
@@ -129,6 +138,15 @@ def main():
         # Wait 20 seconds for first
         logger.info("Waiting for project to clear in database")
         time.sleep(20)
+    # Send the results saved in the outbox by previous runs,
+    # their folders are completed when they are checked below
+    replay_outbox()
+    folder_watch = None
+    if getattr(settings, 'watch', None) is not None:
+        # Before the first pass, to get the changes made while it runs
+        folder_watch = FolderWatch(settings.project_datastorage, settings.watch,
+                                   quiet=getattr(settings, 'watch_quiet', 300),
+                                   poll_interval=getattr(settings, 'watch_poll', 60))
     # Generate list of folders in the path
     folders = []
     for entry in os.scandir(settings.project_datastorage):
@@ -141,9 +159,12 @@ def main():
     # No folders found
     if len(folders) == 0:
         logger.info(f"No folders found in: {settings.project_datastorage}")
-        return True
+        if folder_watch is None:
+            return True
     # Check each folder
     # logger.info(f"project_info: {project_info}")
+    # Path of each folder_id, to check a folder again once its results in the outbox are sent
+    folder_paths = {}
     for folder in folders:
         working_on = f"Working on folder: {folder}"
         logger.info(working_on)
@@ -152,14 +173,68 @@ def main():
         if res is False:
             logger.error(f"Folder {folder} returned error")
             # sys.exit(1)
+        else:
+            folder_paths[str(res)] = folder
+    # Keep checking the folders as files change
+    if folder_watch is not None:
+        watch_folders(project_info, folder_paths, folder_watch)
     logger.info("Script completed on {}".format(time.strftime("%Y%m%d_%H%M%S", time.localtime())))
     return True
 
 
+def replay_outbox():
+    """
+    Send the results saved in the outbox and update the stats of their
+    folders, returns the folder_ids with results sent
+    """
+    outbox = get_outbox()
+    if outbox is None:
+        return set()
+    empty, folder_ids = outbox.replay(logger)
+    for folder_id in folder_ids:
+        update_folder_stats(folder_id, logger)
+    return folder_ids
+
+
+def watch_folders(project_info, folder_paths, folder_watch):
+    """
+    Check the folders that changed, instead of scanning all of them again.
+    folder_watch was started before the first pass, so the changes made
+    while it ran are checked first. The outbox is sent every watch_quiet
+    seconds, and the folders with results in it are checked again to
+    complete them.
+    """
+    logger.info(f"Watching {settings.project_datastorage} ({folder_watch.mode})")
+    try:
+        while True:
+            changed = folder_watch.wait(timeout=folder_watch.quiet)
+            for folder_id in replay_outbox():
+                folder = folder_paths.get(folder_id)
+                if folder is not None and folder not in changed:
+                    changed[folder] = None
+            for folder, files in changed.items():
+                if not os.path.isdir(folder):
+                    continue
+                if files is None:
+                    logger.info(f"Changes in folder: {folder}")
+                else:
+                    logger.info(f"Changes in folder: {folder} ({len(files)} files)")
+                res = run_checks_folder_p(project_info, folder, log_folder, logger, only_files=files)
+                if res is False:
+                    logger.error(f"Folder {folder} returned error")
+                else:
+                    folder_paths[str(res)] = folder
+    finally:
+        folder_watch.close()
+
+
 ############################################
 # Main loop
 ############################################
 if __name__ == "__main__":
+    logfile = start_logging()
+    check_programs()
     main()
-    compress_log()
+    stop_logging()
+    compress_log(logfile)
 
@@ -0,0 +1,15 @@
+# The modules of the worker are in the folder above
+import os
+import sys
+import importlib.util
+import importlib.machinery
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Without a settings.py, the defaults of the template
+if importlib.util.find_spec('settings') is None:
+    loader = importlib.machinery.SourceFileLoader('settings', os.path.join(ROOT, 'settings.py.template'))
+    settings = importlib.util.module_from_spec(importlib.util.spec_from_loader('settings', loader))
+    loader.exec_module(settings)
+    sys.modules['settings'] = settings
@@ -0,0 +1,52 @@
+# Reading the XML output of JHOVE
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from functions import jhove_report
+
+
+HEAD = b"""<?xml version="1.0" encoding="UTF-8"?>
+<jhove xmlns="http://schema.openpreservation.org/ois/xml/ns/jhove" name="Jhove" release="1.28.0">
+ <repInfo uri="test.tif">
+  <reportingModule release="1.9.2">TIFF-hul</reportingModule>
+  <size>86</size>
+  <format>TIFF</format>
+  <status>Well-Formed, but not valid</status>
+  <sigMatch><module>TIFF-hul</module></sigMatch>
+  <messages>
+   <message severity="error">WhiteBalance value out of range: 5</message>
+   <message severity="error">Value offset not word-aligned: 9</message>
+  </messages>
+"""
+TAIL = b"""  <mimeType>image/tiff</mimeType>
+  <properties><property><name>TIFFMetadata</name></property></properties>
+ </repInfo>
+</jhove>
+"""
+MESSAGES = ["WhiteBalance value out of range: 5", "Value offset not word-aligned: 9"]
+
+
+def test_report():
+    assert jhove_report(HEAD + TAIL) == ("Well-Formed, but not valid", MESSAGES)
+
+
+def test_valid_without_messages():
+    xml = HEAD.split(b"  <messages>")[0].replace(b"Well-Formed, but not valid", b"Well-Formed and valid") + TAIL
+    assert jhove_report(xml) == ("Well-Formed and valid", [])
+
+
+def test_truncated_after_messages():
+    assert jhove_report(HEAD + b"  <mimeType>image/ti") == ("Well-Formed, but not valid", MESSAGES)
+    assert jhove_report(HEAD) == ("Well-Formed, but not valid", MESSAGES)
+
+
+def test_not_read_after_messages():
+    # Not well-formed in the properties, which are not parsed
+    xml = HEAD + b"  <properties><property></name></properties>\n" * 10000
+    assert jhove_report(xml) == ("Well-Formed, but not valid", MESSAGES)
+
+
+def test_truncated_before_status():
+    with pytest.raises(ET.ParseError):
+        jhove_report(HEAD.split(b"<status>")[0])
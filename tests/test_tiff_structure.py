@@ -0,0 +1,50 @@
+# Structural check of TIFF files, with files made by hand
+import struct
+
+from tiff_structure import tiff_problems
+
+
+def classic_tiff(entries, extra=b''):
+    """
+    Little-endian TIFF with one IFD of (tag, type, count, value) entries after the header
+    """
+    data = b'II' + struct.pack('<HL', 42, 8) + struct.pack('<H', len(entries))
+    for tag, field_type, count, value in entries:
+        data += struct.pack('<HHLL', tag, field_type, count, value)
+    return data + struct.pack('<L', 0) + extra
+
+
+def write(tmp_path, data):
+    file_path = tmp_path / "test.tif"
+    file_path.write_bytes(data)
+    return str(file_path)
+
+
+def test_well_formed(tmp_path):
+    # 1x1 pixel, one byte strip right after the IFD
+    strip_offset = 8 + 2 + 6 * 12 + 4
+    data = classic_tiff([(256, 3, 1, 1), (257, 3, 1, 1), (262, 3, 1, 1),
+                         (273, 4, 1, strip_offset), (278, 3, 1, 1), (279, 4, 1, 1)], b'\0')
+    assert tiff_problems(write(tmp_path, data)) == []
+
+
+def test_strip_past_the_end(tmp_path):
+    data = classic_tiff([(256, 3, 1, 1), (257, 3, 1, 1), (262, 3, 1, 1),
+                         (273, 4, 1, 1000), (278, 3, 1, 1), (279, 4, 1, 1)])
+    assert tiff_problems(write(tmp_path, data)) == ["IFD 0: strip 0 past the end of the file"]
+
+
+def test_truncated_ifd(tmp_path):
+    # The IFD has 6 entries but the file ends after the first one
+    data = classic_tiff([(256, 3, 1, 1), (257, 3, 1, 1), (262, 3, 1, 1),
+                         (273, 4, 1, 0), (278, 3, 1, 1), (279, 4, 1, 1)])
+    problems = tiff_problems(write(tmp_path, data[:8 + 2 + 12]))
+    assert problems == ["IFD 0: 6 entries past the end of the file"]
+
+
+def test_oversized_ifd_count(tmp_path):
+    # BigTIFF of 88 bytes with a count of entries that does not fit in memory
+    data = b'II' + struct.pack('<HHHQ', 43, 8, 0, 16) + struct.pack('<Q', 2 ** 60)
+    data += b'\0' * (88 - len(data))
+    problems = tiff_problems(write(tmp_path, data))
+    assert problems == [f"IFD 0: {2 ** 60} entries past the end of the file"]
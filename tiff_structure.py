@@ -0,0 +1,201 @@
+# Structural check of TIFF files for osprey_worker.py, in Python
+# and reading only the header and the IFDs, to decide which files
+# need the full validation with JHOVE
+import os
+import struct
+
+
+# Size in bytes of each TIFF field type
+TYPE_SIZES = {
+    1: 1,   # BYTE
+    2: 1,   # ASCII
+    3: 2,   # SHORT
+    4: 4,   # LONG
+    5: 8,   # RATIONAL
+    6: 1,   # SBYTE
+    7: 1,   # UNDEFINED
+    8: 2,   # SSHORT
+    9: 4,   # SLONG
+    10: 8,  # SRATIONAL
+    11: 4,  # FLOAT
+    12: 8,  # DOUBLE
+    13: 4,  # IFD
+    16: 8,  # LONG8, BigTIFF
+    17: 8,  # SLONG8, BigTIFF
+    18: 8,  # IFD8, BigTIFF
+}
+SHORT, LONG, RATIONAL, LONG8 = 3, 4, 5, 16
+INTEGER_FORMATS = {1: 'B', 3: 'H', 4: 'L', 13: 'L', 16: 'Q', 18: 'Q'}
+
+# Allowed types of the baseline tags
+TAG_TYPES = {
+    256: (SHORT, LONG),             # ImageWidth
+    257: (SHORT, LONG),             # ImageLength
+    258: (SHORT,),                  # BitsPerSample
+    259: (SHORT,),                  # Compression
+    262: (SHORT,),                  # PhotometricInterpretation
+    273: (SHORT, LONG, LONG8),      # StripOffsets
+    277: (SHORT,),                  # SamplesPerPixel
+    278: (SHORT, LONG, LONG8),      # RowsPerStrip
+    279: (SHORT, LONG, LONG8),      # StripByteCounts
+    282: (RATIONAL,),               # XResolution
+    283: (RATIONAL,),               # YResolution
+    296: (SHORT,),                  # ResolutionUnit
+    322: (SHORT, LONG),             # TileWidth
+    323: (SHORT, LONG),             # TileLength
+    324: (LONG, LONG8),             # TileOffsets
+    325: (SHORT, LONG, LONG8),      # TileByteCounts
+}
+REQUIRED_TAGS = {256: "ImageWidth", 257: "ImageLength", 262: "PhotometricInterpretation"}
+# Max. no. of IFDs to follow, to stop on damaged chains
+MAX_IFDS = 10000
+
+
+class TiffStructure(object):
+    """
+    Reads the IFDs of a TIFF file and collects the structural problems found
+    """
+    def __init__(self, f, file_size):
+        self.f = f
+        self.file_size = file_size
+        self.problems = []
+
+    def read(self, offset, size):
+        self.f.seek(offset)
+        data = self.f.read(size)
+        if len(data) != size:
+            raise EOFError(f"{size} bytes at offset {offset} past the end of the file")
+        return data
+
+    def header(self):
+        """
+        Read the header, returns the offset of the first IFD
+        """
+        data = self.read(0, 8)
+        if data[:2] == b'II':
+            self.order = '<'
+        elif data[:2] == b'MM':
+            self.order = '>'
+        else:
+            raise ValueError(f"Not a TIFF file, byte order {data[:2]}")
+        version = struct.unpack(self.order + 'H', data[2:4])[0]
+        if version == 42:
+            self.big = False
+            return struct.unpack(self.order + 'L', data[4:8])[0]
+        if version == 43:
+            self.big = True
+            offset_size, _ = struct.unpack(self.order + 'HH', data[4:8])
+            if offset_size != 8:
+                raise ValueError(f"BigTIFF with offsets of {offset_size} bytes")
+            return struct.unpack(self.order + 'Q', self.read(8, 8))[0]
+        raise ValueError(f"Unknown TIFF version {version}")
+
+    def ifd(self, offset, no_ifd):
+        """
+        Read the IFD at offset, returns its entries by tag and the offset of the next IFD
+        """
+        count_format, entry_format, entry_size, next_format = ('Q', 'HHQ8s', 20, 'Q') if self.big else ('H', 'HHL4s', 12, 'L')
+        count_size = struct.calcsize(self.order + count_format)
+        no_entries = struct.unpack(self.order + count_format, self.read(offset, count_size))[0]
+        if no_entries == 0:
+            raise ValueError(f"IFD {no_ifd} has no entries")
+        next_size = struct.calcsize(self.order + next_format)
+        # Before reading, a damaged count can be larger than the memory
+        if offset + count_size + no_entries * entry_size + next_size > self.file_size:
+            raise ValueError(f"IFD {no_ifd}: {no_entries} entries past the end of the file")
+        data = self.read(offset + count_size, no_entries * entry_size + next_size)
+        entries = {}
+        last_tag = -1
+        for i in range(no_entries):
+            tag, field_type, count, value = struct.unpack_from(self.order + entry_format, data, i * entry_size)
+            if tag <= last_tag:
+                self.problems.append(f"IFD {no_ifd}: tags are not in ascending order ({tag} after {last_tag})")
+            last_tag = tag
+            if field_type not in TYPE_SIZES:
+                self.problems.append(f"IFD {no_ifd}: unknown type {field_type} for tag {tag}")
+                continue
+            size = TYPE_SIZES[field_type] * count
+            if size > len(value):
+                value_offset = struct.unpack(self.order + ('Q' if self.big else 'L'), value)[0]
+                if value_offset + size > self.file_size:
+                    self.problems.append(f"IFD {no_ifd}: value of tag {tag} past the end of the file")
+                    continue
+            entries[tag] = (field_type, count, value)
+        next_offset = struct.unpack_from(self.order + next_format, data, no_entries * entry_size)[0]
+        return entries, next_offset
+
+    def values(self, entry):
+        """
+        Integer values of an entry
+        """
+        field_type, count, value = entry
+        value_format = self.order + INTEGER_FORMATS[field_type] * count
+        size = struct.calcsize(value_format)
+        if size > len(value):
+            value = self.read(struct.unpack(self.order + ('Q' if self.big else 'L'), value)[0], size)
+        return struct.unpack_from(value_format, value)
+
+    def check_ifd(self, entries, no_ifd):
+        for tag, name in REQUIRED_TAGS.items():
+            if tag not in entries:
+                self.problems.append(f"IFD {no_ifd}: missing required tag {name}")
+        for tag, types in TAG_TYPES.items():
+            if tag in entries and entries[tag][0] not in types:
+                self.problems.append(f"IFD {no_ifd}: tag {tag} with type {entries[tag][0]}")
+        if 273 in entries or 279 in entries:
+            offsets_tag, counts_tag, kind = 273, 279, "strip"
+        elif 324 in entries or 325 in entries:
+            offsets_tag, counts_tag, kind = 324, 325, "tile"
+        else:
+            self.problems.append(f"IFD {no_ifd}: no strip or tile offsets")
+            return
+        if offsets_tag not in entries or counts_tag not in entries:
+            self.problems.append(f"IFD {no_ifd}: {kind} offsets without byte counts or the reverse")
+            return
+        if entries[offsets_tag][0] not in TAG_TYPES[offsets_tag] or entries[counts_tag][0] not in TAG_TYPES[counts_tag]:
+            return
+        offsets = self.values(entries[offsets_tag])
+        byte_counts = self.values(entries[counts_tag])
+        if len(offsets) != len(byte_counts):
+            self.problems.append(f"IFD {no_ifd}: {len(offsets)} {kind} offsets but {len(byte_counts)} byte counts")
+        for i, (offset, byte_count) in enumerate(zip(offsets, byte_counts)):
+            if offset + byte_count > self.file_size:
+                self.problems.append(f"IFD {no_ifd}: {kind} {i} past the end of the file")
+                break
+
+    def check(self):
+        offset = self.header()
+        visited = set()
+        no_ifd = 0
+        while offset != 0:
+            if offset in visited:
+                self.problems.append(f"IFD {no_ifd}: loop in the IFD chain")
+                break
+            if offset % 2 != 0:
+                self.problems.append(f"IFD {no_ifd}: offset {offset} not on a word boundary")
+            if offset >= self.file_size:
+                self.problems.append(f"IFD {no_ifd}: offset {offset} past the end of the file")
+                break
+            if no_ifd >= MAX_IFDS:
+                self.problems.append(f"More than {MAX_IFDS} IFDs")
+                break
+            visited.add(offset)
+            entries, offset = self.ifd(offset, no_ifd)
+            self.check_ifd(entries, no_ifd)
+            no_ifd += 1
+        return self.problems
+
+
+def tiff_problems(file_path):
+    """
+    Check the structure of a TIFF file: header, chain of IFDs, offsets within
+    the file, strip and tile byte counts, required baseline tags and the types
+    of the baseline tags. Returns a list with the problems found, empty if
+    the file looks well-formed.
+    """
+    file_size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        try:
+            return TiffStructure(f, file_size).check()
+        except (ValueError, EOFError, struct.error) as e:
+            return [str(e)]
@@ -0,0 +1,212 @@
+# Watch the folders of a project for osprey_worker.py
+import os
+import time
+import errno
+import struct
+import select
+import ctypes
+import ctypes.util
+
+from functions import scan_folder, fs_type, REMOTE_FS
+
+
+# inotify events, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher(object):
+    """
+    Changes of the files under root with inotify, through ctypes
+    """
+    def __init__(self, root):
+        self.root = root
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # Watched folder, by watch descriptor
+        self.watches = {}
+        self.add_tree(root)
+
+    def add_tree(self, path):
+        self.add_watch(path)
+        for dirpath, dirnames, filenames in os.walk(path):
+            for d in dirnames:
+                try:
+                    self.add_watch(os.path.join(dirpath, d))
+                except OSError:
+                    # Removed or renamed after os.walk listed it
+                    if os.path.isdir(os.path.join(dirpath, d)):
+                        raise
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        self.watches[wd] = path
+
+    def read(self, timeout):
+        """
+        Wait up to timeout seconds for changes, returns a list of changed paths.
+        None in the list means events were lost and everything has to be checked.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if len(ready) == 0:
+            return []
+        changes = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    changes.append(None)
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if wd not in self.watches:
+                    continue
+                path = os.path.join(self.watches[wd], os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        # Watch the new folder, files may be there before the watch
+                        try:
+                            self.add_tree(path)
+                            changes.extend(record.path for record in scan_folder(path))
+                        except OSError:
+                            # Removed or renamed before it was watched, the events
+                            # of the folder it was moved to have its files
+                            if os.path.isdir(path):
+                                # Changed while it was scanned, check everything
+                                changes.append(None)
+                    changes.append(path)
+                else:
+                    changes.append(path)
+        return changes
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """
+    Changes of the files under root by scanning every `interval` seconds,
+    for filesystems without inotify events (NFS)
+    """
+    def __init__(self, root, interval):
+        self.root = root
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        return {record.path: (record.size, record.mtime, record.inode) for record in scan_folder(self.root)}
+
+    def read(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        snapshot = self.scan()
+        changes = [path for path, values in snapshot.items() if self.snapshot.get(path) != values]
+        changes.extend(path for path in self.snapshot if path not in snapshot)
+        self.snapshot = snapshot
+        return changes
+
+    def close(self):
+        pass
+
+
+class FolderWatch(object):
+    """
+    Track the changes in the folders under root. A folder is ready to be
+    checked after `quiet` seconds without changes, so an upload in progress
+    is not checked until it has finished.
+
+    mode is "inotify", "poll" or "auto" (inotify unless root is in a
+    network filesystem or inotify is not available).
+    """
+    def __init__(self, root, mode="auto", quiet=300, poll_interval=60):
+        self.root = os.path.abspath(root)
+        self.quiet = quiet
+        self.watcher = None
+        if mode == "auto":
+            mode = "poll" if fs_type(self.root) in REMOTE_FS else "inotify"
+        if mode == "inotify":
+            try:
+                self.watcher = InotifyWatcher(self.root)
+            except (OSError, AttributeError):
+                mode = "poll"
+        if self.watcher is None:
+            self.watcher = PollingWatcher(self.root, poll_interval)
+        self.mode = mode
+        # Time of the last change and changed files, by folder
+        self.pending = {}
+
+    def folder_of(self, path):
+        rel_path = os.path.relpath(path, self.root)
+        if rel_path.startswith(os.pardir) or (os.sep not in rel_path and not os.path.isdir(path)):
+            # Outside of the folders
+            return None
+        return os.path.join(self.root, rel_path.split(os.sep)[0])
+
+    def add_changes(self, changes):
+        now = time.monotonic()
+        for path in changes:
+            if path is None:
+                # Lost events, check every folder in full
+                for entry in os.scandir(self.root):
+                    if entry.is_dir():
+                        self.pending[entry.path] = (now, None)
+                continue
+            folder = self.folder_of(path)
+            if folder is None:
+                continue
+            last_change, files = self.pending.get(folder, (now, set()))
+            if files is not None and path != folder:
+                files.add(path)
+            self.pending[folder] = (now, files)
+
+    def wait(self, timeout=None):
+        """
+        Wait until at least one folder is ready, or for timeout seconds if given,
+        returns a dict with the changed files of each ready folder (None to check
+        the whole folder), empty after the timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            ready = {folder: files for folder, (last_change, files) in self.pending.items()
+                     if now - last_change >= self.quiet}
+            if len(ready) > 0:
+                for folder in ready:
+                    del self.pending[folder]
+                return ready
+            if deadline is not None and now >= deadline:
+                return {}
+            if len(self.pending) > 0:
+                # Until the first folder would be ready
+                read_timeout = self.quiet - (now - min(last_change for last_change, files in self.pending.values()))
+                read_timeout = max(1, min(read_timeout, self.quiet))
+            else:
+                read_timeout = self.quiet
+            if deadline is not None:
+                read_timeout = max(0, min(read_timeout, deadline - now))
+            self.add_changes(self.watcher.read(read_timeout))
+
+    def close(self):
+        self.watcher.close()
@@ -0,0 +1,153 @@
+# Logging of osprey_worker.py: the main process and the worker processes put
+# the records in a queue and a single thread writes them to a log file
+# that is rotated and compressed with gzip
+import os
+import gzip
+import queue
+import shutil
+import atexit
+import logging
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Get settings
+import settings
+
+
+# Queue of the worker processes and listeners of this run, set by setup_logging
+_log_queue = None
+_listeners = []
+
+
+def gzip_namer(name):
+    return f"{name}.gz"
+
+
+def gzip_rotator(source, dest):
+    """
+    Compress the log file that was rotated
+    """
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def setup_logging(logfile, level=logging.DEBUG, fmt=None, datefmt=None):
+    """
+    Send the records of the root logger to a queue, written to logfile by a
+    thread. The file is rotated after settings.log_max_bytes and the last
+    settings.log_backups files are kept, compressed. Returns the queue for
+    the worker processes, with a thread of its own writing to the same file.
+    """
+    global _log_queue, _listeners
+    handler = RotatingFileHandler(logfile, mode='a', maxBytes=getattr(settings, 'log_max_bytes', 100 * 1024 * 1024),
+                                  backupCount=getattr(settings, 'log_backups', 10))
+    handler.namer = gzip_namer
+    handler.rotator = gzip_rotator
+    handler.setFormatter(logging.Formatter(fmt, datefmt))
+    # The threads of this process use a queue of threads, the records are not
+    # pickled. The workers of the pool send theirs to a queue of processes,
+    # made with the start method of the pool.
+    main_queue = queue.Queue()
+    _log_queue = multiprocessing.get_context(getattr(settings, 'pool_start_method', 'forkserver')).Queue()
+    _listeners = [QueueListener(main_queue, handler), QueueListener(_log_queue, handler)]
+    for listener in _listeners:
+        listener.start()
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(main_queue)]
+    root.setLevel(level)
+    atexit.register(stop_logging)
+    return _log_queue
+
+
+def get_log_queue():
+    """
+    Queue for the records of the worker processes, None if setup_logging has not run
+    """
+    return _log_queue
+
+
+def worker_logging_init(log_queue, level=logging.DEBUG):
+    """
+    Log to log_queue from a worker process, instead of the handlers
+    copied from the parent
+    """
+    if log_queue is None:
+        return
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(level)
+
+
+def stop_logging():
+    """
+    Write the records left in the queues and close the log file
+    """
+    global _listeners
+    if len(_listeners) == 0:
+        return
+    for listener in _listeners:
+        listener.stop()
+    for handler in _listeners[0].handlers:
+        handler.close()
+    _listeners = []
+
+
+def repr_pieces(value, max_length):
+    """
+    Text of value as in str() of a container, in pieces, with the strings
+    and bytes cut to max_length so they are not converted to text in full
+    """
+    if isinstance(value, dict):
+        yield '{'
+        for i, (k, v) in enumerate(value.items()):
+            if i > 0:
+                yield ', '
+            yield from repr_pieces(k, max_length)
+            yield ': '
+            yield from repr_pieces(v, max_length)
+        yield '}'
+    elif isinstance(value, (list, tuple)):
+        yield '[' if isinstance(value, list) else '('
+        for i, v in enumerate(value):
+            if i > 0:
+                yield ', '
+            yield from repr_pieces(v, max_length)
+        if isinstance(value, tuple) and len(value) == 1:
+            yield ','
+        yield ']' if isinstance(value, list) else ')'
+    elif isinstance(value, (str, bytes)):
+        yield repr(value[:max_length + 1])
+    else:
+        yield repr(value)
+
+
+class Truncated(object):
+    """
+    Value to log, cut to settings.log_payload_max characters when the
+    message is formatted. QueueHandler formats it when the record is put
+    on the queue, in the thread that logs it, so large values (EXIF, lists
+    of files) are only converted to text if the logger's level lets the
+    record through, and then only up to log_payload_max
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        max_length = getattr(settings, 'log_payload_max', 2000)
+        if max_length is None:
+            return str(self.value)
+        if isinstance(self.value, (dict, list, tuple, bytes)):
+            pieces = repr_pieces(self.value, max_length)
+        else:
+            pieces = [str(self.value)]
+        text = []
+        length = 0
+        for piece in pieces:
+            text.append(piece)
+            length += len(piece)
+            if length > max_length:
+                return f"{''.join(text)[:max_length]}... (cut at {max_length} characters)"
+        return ''.join(text)